@@ -1,53 +1,267 @@
+import asyncio
+import hashlib
+import json
+import math
+import re
 from collections import defaultdict
-from random import randint
-from time import sleep
 
-from flask import Flask, jsonify, request
+from aiohttp import web
 
-app = Flask(__name__)
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError:
+    h2 = None
 
-data = defaultdict(list)
 
+def uniforms(*key):
+    # Two deterministic floats in [0, 1) for the given key, so every node behaves the same on every run
+    digest = hashlib.blake2b(":".join(map(str, key)).encode(), digest_size=16).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64, int.from_bytes(digest[8:], "big") / 2 ** 64
 
-def alter_rute(f):
-    def wrapper(*args, **kwargs):
-        sleep(randint(1, 5))
-        if randint(0, 5) == 5:
-            return "", 500
-        a = f(*args, **kwargs)
-        print("NUMBER OF NODES:", len({k: v for k, v in data.items() if v}))
-        print("DATA:", data)
-        return a
-    wrapper.__name__ = f.__name__
-    return wrapper
 
+class Latency():
+
+    def __init__(self, spec):
+        # fixed:<seconds>, uniform:<min>,<max> or exponential:<mean>
+        self.kind, _, params = spec.partition(":")
+        self.params = [float(i) for i in params.split(",") if i]
+        if self.kind not in ("fixed", "uniform", "exponential"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, u):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.params[0] + (self.params[1] - self.params[0]) * u
+        return -self.params[0] * math.log(1 - u)
+
+
+class FakeCluster():
+
+    endpoints = ("get", "create", "delete")
+
+    def __init__(self, latency="uniform:1,5", failure_rate=1 / 6, seed=0, slow_nodes=0, slow_factor=10, flaky_nodes=0,
+                 flaky_failure_rate=0.5):
+        self.latency = Latency(latency)
+        self.failure_rate = failure_rate
+        self.seed = seed
+        # Ratio of nodes with slow_factor times the latency and ratio of nodes failing with flaky_failure_rate
+        self.slow_nodes = slow_nodes
+        self.slow_factor = slow_factor
+        self.flaky_nodes = flaky_nodes
+        self.flaky_failure_rate = flaky_failure_rate
+
+        self.groups = defaultdict(set)
+        # node -> requests per endpoint
+        self.requests = defaultdict(lambda: [0] * len(self.endpoints))
+        self._profiles = {}
+
+    def profile(self, node):
+        profile = self._profiles.get(node)
+        if profile is None:
+            slow, flaky = uniforms(self.seed, node, "profile")
+            profile = self._profiles[node] = (
+                self.slow_factor if slow < self.slow_nodes else 1,
+                self.flaky_failure_rate if flaky < self.flaky_nodes else self.failure_rate,
+            )
+        return profile
+
+    async def simulate(self, node, endpoint, timeout=None):
+        # A client giving up after `timeout` seconds gets an asyncio.TimeoutError, without a timer of its own
+        requests = self.requests[node]
+        count = sum(requests)
+        requests[self.endpoints.index(endpoint)] += 1
+
+        latency_factor, failure_rate = self.profile(node)
+        u_latency, u_failure = uniforms(self.seed, node, count)
+        delay = self.latency.sample(u_latency) * latency_factor
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        if delay:
+            await asyncio.sleep(delay)
+        return u_failure < failure_rate
+
+    # Each endpoint gives the status and the body, a dict for JSON, so the HTTP/1.1 and HTTP/2 servers share them
+    async def create(self, node, group, timeout=None):
+        if await self.simulate(node, "create", timeout):
+            return 500, ""
+        if group in self.groups[node]:
+            return 400, "An error. Perhaps the object exists"
+        self.groups[node].add(group)
+        return 201, {"groupId": group}
+
+    async def delete(self, node, group, timeout=None):
+        if await self.simulate(node, "delete", timeout):
+            return 500, ""
+        self.groups[node].discard(group)
+        return 200, ""
+
+    async def get(self, node, name, timeout=None):
+        if await self.simulate(node, "get", timeout):
+            return 500, ""
+        if name in self.groups[node]:
+            return 200, {"groupId": name}
+        return 404, "Not Found"
+
+    @staticmethod
+    def response(status, body):
+        if isinstance(body, dict):
+            return web.json_response(body, status=status)
+        return web.Response(status=status, text=body or None)
+
+    async def create_group(self, request):
+        group = (await request.json()).get("groupId")
+        return self.response(*await self.create(request.match_info["node"], group))
+
+    async def delete_group(self, request):
+        group = (await request.json()).get("groupId")
+        return self.response(*await self.delete(request.match_info["node"], group))
+
+    async def get_group(self, request):
+        return self.response(*await self.get(request.match_info["node"], request.match_info["name"]))
+
+    def stats(self, per_node=False):
+        totals = [sum(i) for i in zip(*self.requests.values())] or [0] * len(self.endpoints)
+        stats = {
+            "nodes": len(self.requests),
+            "nodes_with_groups": sum(1 for i in self.groups.values() if i),
+            "requests": dict(zip(self.endpoints, totals)),
+        }
+        if per_node:
+            stats["per_node"] = {node: dict(zip(self.endpoints, i)) for node, i in self.requests.items()}
+        return stats
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats(per_node="per_node" in request.query))
+
+    async def reset_stats(self, request):
+        self.requests.clear()
+        return web.Response(status=200)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/{node}/v1/group", self.create_group)
+        app.router.add_delete("/{node}/v1/group", self.delete_group)
+        app.router.add_get("/{node}/v1/group/{name}", self.get_group)
+        app.router.add_get("/_stats", self.get_stats)
+        app.router.add_delete("/_stats", self.reset_stats)
+        return app
+
+
+class Http2Server():
+
+    # The fake cluster over cleartext HTTP/2 with prior knowledge (h2c), every request is a stream and the streams of a
+    # connection are answered concurrently. Needs h2
+    routes = (
+        ("POST", re.compile(r"/([^/]+)/v1/group"), "create"),
+        ("DELETE", re.compile(r"/([^/]+)/v1/group"), "delete"),
+        ("GET", re.compile(r"/([^/]+)/v1/group/([^/]+)"), "get"),
+    )
+
+    def __init__(self, cluster):
+        if h2 is None:
+            raise RuntimeError("The HTTP/2 server needs h2: pip install h2")
+        self.cluster = cluster
+        self.connections = 0
+        self.streams = 0
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        connection = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+        connection.initiate_connection()
+        writer.write(connection.data_to_send())
+        # stream id -> (headers, body)
+        requests = {}
+        tasks = set()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        requests[event.stream_id] = (dict(event.headers), bytearray())
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].extend(event.data)
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = requests.pop(event.stream_id)
+                        task = asyncio.ensure_future(self._respond(connection, writer, event.stream_id, headers, body))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif isinstance(event, h2.events.StreamReset):
+                        requests.pop(event.stream_id, None)
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                writer.write(connection.data_to_send())
+        except (ConnectionError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _respond(self, connection, writer, stream_id, headers, body):
+        self.streams += 1
+        method, path = headers[b":method"].decode(), headers[b":path"].decode()
+        status, content = 404, "Not Found"
+        for route_method, pattern, endpoint in self.routes:
+            match = pattern.fullmatch(path)
+            if match and method == route_method:
+                argument = match.group(2) if endpoint == "get" else json.loads(body or b"{}").get("groupId")
+                status, content = await getattr(self.cluster, endpoint)(match.group(1), argument)
+                break
+        content_type = "application/json" if isinstance(content, dict) else "text/plain"
+        content = (json.dumps(content) if isinstance(content, dict) else content).encode()
+        try:
+            connection.send_headers(stream_id, [(":status", str(status)), ("content-type", content_type),
+                                                ("content-length", str(len(content)))])
+            connection.send_data(stream_id, content, end_stream=True)
+        except h2.exceptions.StreamClosedError:
+            # The client gave up on the request
+            return
+        writer.write(connection.data_to_send())
 
-@app.route("/<node>/v1/group", methods=['POST'])
-@alter_rute
-def create_group(node):
-    group = request.json.get("groupId")
-    if group not in data[node]:
-        data[node].append(group)
-        return jsonify({"groupId": group}), 201
-    else:
-        return "An error. Perhaps the object exists", 400
 
+if __name__ == '__main__':
+    import argparse
 
-@app.route("/<node>/v1/group", methods=['DELETE'])
-@alter_rute
-def delete_group(node):
-    group = request.json.get("groupId")
-    try:
-        data[node].remove(group)
-    except ValueError:
-        pass
-    return "", 200
+    parser = argparse.ArgumentParser(description='Fake Node API, every /<node>/ prefix is a virtual node')
+    parser.add_argument('--host', type=str, default="0.0.0.0")
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=str, default="uniform:1,5",
+                        help="Latency of each request: fixed:<s>, uniform:<min>,<max> or exponential:<mean>")
+    parser.add_argument('--failure-rate', type=float, default=1 / 6, help="Ratio of requests answered with a 500")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the latency and failures of every node")
+    parser.add_argument('--slow-nodes', type=float, default=0, help="Ratio of slow nodes")
+    parser.add_argument('--slow-factor', type=float, default=10, help="Latency multiplier of the slow nodes")
+    parser.add_argument('--flaky-nodes', type=float, default=0, help="Ratio of flaky nodes")
+    parser.add_argument('--flaky-failure-rate', type=float, default=0.5, help="Failure rate of the flaky nodes")
+    parser.add_argument('--http2', action='store_true', help="Serve cleartext HTTP/2 (h2c) instead of HTTP/1.1")
+    args = parser.parse_args()
 
+    cluster = FakeCluster(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed, slow_nodes=args.slow_nodes,
+                          slow_factor=args.slow_factor, flaky_nodes=args.flaky_nodes,
+                          flaky_failure_rate=args.flaky_failure_rate)
+    if args.http2:
+        async def serve():
+            server = Http2Server(cluster)
+            await server.start(args.host, args.port)
+            await server.server.serve_forever()
 
-@app.route("/<node>/v1/group/<name>", methods=['GET'])
-@alter_rute
-def get_group(node, name):
-    if name in data[node]:
-        return jsonify({"groupId": name}), 200
+        asyncio.run(serve())
     else:
-        return "Not Found", 404
+        web.run_app(cluster.app(), host=args.host, port=args.port, backlog=4096)
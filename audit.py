@@ -0,0 +1,122 @@
+import json
+import logging
+from array import array
+from collections import Counter
+
+from tenacity import RetryError
+
+from coroutine import Coroutine, CoroutineState
+from node import NodeActionState
+
+logger = logging.getLogger(__name__)
+
+# Group on the node according to the status of a create_group action
+FOUND = {
+    NodeActionState.NOT_NEEDED.value: "present",
+    NodeActionState.READY.value: "absent",
+}
+
+
+def error_message(e):
+    if isinstance(e, RetryError):
+        e = e.last_attempt.exception()
+    return str(e) or e.__class__.__name__
+
+
+class AuditCoroutine(Coroutine):
+
+    # Checks the groups on every node in one pass, bounded by the concurrency of the session, and writes a JSON line to
+    # `report` for each (node, group) not in the expected state as soon as it is known: the group is "present",
+    # "absent" or "unknown" when the node did not answer. `expect` is "present", "absent" or "majority", the state of
+    # most nodes of the group, known once all of them answered. With `repair` only the drifted nodes are changed, each
+    # line tells the outcome. A summary line per group ends the report
+
+    expectations = ("present", "absent", "majority")
+
+    def __init__(self, nodes, group, report, expect="majority", repair=False, session=None, concurrency=100):
+        if expect not in self.expectations:
+            raise ValueError(f"Unknown expectation: {expect}")
+        super().__init__("create_group", nodes, group, session=session, concurrency=concurrency)
+        self.action = "audit"
+        self.report = report
+        self.expect = expect
+        self.repair = repair
+        self.expected = {group: expect for group in self.groups}
+        # group -> consistent, drifted, repaired and unknown nodes
+        self.counts = {group: Counter() for group in self.groups}
+        self._errors = {}
+
+    async def _run(self):
+        if self.expect != "majority":
+            with self._phase("audit"):
+                await self._execute(self._scheduled_tasks(), self._check_and_repair)
+        else:
+            with self._phase("status"):
+                await self._execute(self._scheduled_tasks(), self._check)
+            # Only the nodes not in the state of the majority go through the second pass
+            rows = array("I")
+            for group, found in self._found_by_group().items():
+                expected = self.expected[group] = "present" if found["present"] > found["absent"] else "absent"
+                logger.info(f"Expecting {group} {expected}: {dict(found)}")
+                self.counts[group]["consistent"] = found[expected]
+                drifted = NodeActionState.READY if expected == "present" else NodeActionState.NOT_NEEDED
+                rows.extend(self.table.select([drifted, NodeActionState.ERROR], groups={group}))
+            with self._phase("audit"):
+                await self._execute(self._tasks(self._schedule(rows)), self._compare_and_repair)
+
+        for group in self.groups:
+            counts = self.counts[group]
+            unresolved = counts["unknown"] + counts["drifted"] - counts["repaired"]
+            if self._inventory_failed or unresolved:
+                self.statuses[group] = CoroutineState.ERROR
+                logger.error(f"Audit of {group}: {unresolved} nodes not as expected")
+                self.errors[group].append(f"{unresolved} nodes not as expected")
+            else:
+                self.statuses[group] = CoroutineState.DONE
+            self._write({"group": group, "expected": self.expected[group], **{
+                key: counts[key] for key in ("consistent", "drifted", "repaired", "unknown")}})
+
+    async def _check(self, task):
+        # Always asked to the node, the answer refreshes the status cache
+        task._remember(task.group, None)
+        try:
+            await task.get_current_status(task.group)
+        except Exception as e:
+            self._errors[task.row] = error_message(e)
+
+    async def _check_and_repair(self, task):
+        await self._check(task)
+        await self._compare_and_repair(task)
+
+    async def _compare_and_repair(self, task):
+        counts = self.counts[task.group]
+        found = FOUND.get(self.table.statuses[task.row], "unknown")
+        expected = self.expected[task.group]
+        if found == expected:
+            counts["consistent"] += 1
+            return
+        record = {"node": task.node, "group": task.group, "expected": expected, "found": found}
+        if found == "unknown":
+            counts["unknown"] += 1
+            record["error"] = self._errors.pop(task.row, None)
+        else:
+            counts["drifted"] += 1
+            if self.repair:
+                try:
+                    await (task.forward if expected == "present" else task.backward)(task.group)
+                except Exception as e:
+                    record["repair"] = "error"
+                    record["error"] = error_message(e)
+                else:
+                    record["repair"] = "done"
+                    counts["repaired"] += 1
+        self._write(record)
+
+    def _found_by_group(self):
+        found = {group: Counter() for group in self.groups}
+        for row in range(len(self.table)):
+            found[self.table.group(row)][FOUND.get(self.table.statuses[row], "unknown")] += 1
+        return found
+
+    def _write(self, record):
+        self.report.write(json.dumps(record) + "\n")
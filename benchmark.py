@@ -0,0 +1,220 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import time
+
+import aiohttp
+from aiohttp import web
+
+from app import FakeCluster
+from coroutine import Coroutine
+from node import NodeSession
+
+
+# Node API method of each phase, per action
+PHASES = {
+    "create_group": {"status": "GET", "forward": "POST", "rollback": "DELETE"},
+    "delete_group": {"status": "GET", "forward": "DELETE", "rollback": "POST"},
+}
+
+
+def serve_fake_cluster(port, profile):
+    web.run_app(FakeCluster(**profile).app(), host="127.0.0.1", port=port, print=None, handle_signals=False, backlog=4096)
+
+
+def start_fake_cluster(profile):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.Process(target=serve_fake_cluster, args=(port, profile), daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("The fake cluster did not start")
+
+
+class RequestRecorder():
+
+    def __init__(self):
+        # (method, started_at, ended_at, status), status is None for connection errors
+        self.requests = []
+
+    def trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_start)
+        trace_config.on_request_end.append(self._on_end)
+        trace_config.on_request_exception.append(self._on_exception)
+        return trace_config
+
+    async def _on_start(self, session, context, params):
+        context.started_at = time.perf_counter()
+
+    async def _on_end(self, session, context, params):
+        self.requests.append((params.method, context.started_at, time.perf_counter(), params.response.status))
+
+    async def _on_exception(self, session, context, params):
+        self.requests.append((params.method, context.started_at, time.perf_counter(), None))
+
+
+def open_sockets():
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except FileNotFoundError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            count += os.readlink(f"/proc/self/fd/{fd}").startswith("socket:")
+        except OSError:
+            pass
+    return count
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def latency_summary(latencies):
+    ordered = sorted(latencies)
+    return {
+        "p50": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1] if ordered else None,
+    }
+
+
+async def run_action(action, nodes, groups, concurrency, pipeline, fail_fast):
+    recorder = RequestRecorder()
+    session = NodeSession(limit=concurrency or 0, trace_configs=[recorder.trace_config()])
+    coroutine = Coroutine(action, nodes, groups, session=session, concurrency=concurrency, pipeline=pipeline,
+                          fail_fast=fail_fast)
+
+    peak_sockets = 0
+
+    async def sample_sockets():
+        nonlocal peak_sockets
+        while True:
+            peak_sockets = max(peak_sockets, open_sockets() or 0)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.ensure_future(sample_sockets())
+    started_at = time.perf_counter()
+    try:
+        result = await coroutine.run_async()
+    finally:
+        wall_time = time.perf_counter() - started_at
+        sampler.cancel()
+        await session.close()
+
+    phases = {}
+    for phase, method in PHASES[action].items():
+        requests = [i for i in recorder.requests if i[0] == method]
+        if requests:
+            phases[phase] = {
+                "requests": len(requests),
+                "wall_time": max(i[2] for i in requests) - min(i[1] for i in requests),
+                "latency": latency_summary([i[2] - i[1] for i in requests]),
+            }
+
+    return {
+        "action": action,
+        "status": result.status.name if result.status else None,
+        "wall_time": wall_time,
+        "requests": len(recorder.requests),
+        "requests_per_sec": len(recorder.requests) / wall_time if wall_time else None,
+        "errors": sum(1 for i in recorder.requests if i[3] is None or i[3] >= 500),
+        "latency": latency_summary([i[2] - i[1] for i in recorder.requests]),
+        "phases": phases,
+        "peak_open_sockets": peak_sockets,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    for old, new in zip(previous["runs"], current["runs"]):
+        for key in ("requests_per_sec", "wall_time"):
+            if old[key] and new[key]:
+                print(f"{new['action']} {key}: {old[key]:.3f} -> {new[key]:.3f} ({(new[key] / old[key] - 1) * 100:+.1f}%)")
+        for key in ("p50", "p99"):
+            if old["latency"][key] and new["latency"][key]:
+                print(f"{new['action']} latency {key}: {old['latency'][key]:.4f} -> {new['latency'][key]:.4f}")
+
+
+async def benchmark(args, port):
+    nodes = [f"http://127.0.0.1:{port}/{i}" for i in range(args.nodes)]
+    groups = [f"group_{i}" for i in range(args.groups)]
+    runs = []
+    async with aiohttp.ClientSession() as session:
+        for action in args.actions.split(","):
+            run = await run_action(action, nodes, groups, args.concurrency, args.pipeline, args.fail_fast)
+            # Requests seen by the fake cluster, including the ones the client gave up on
+            async with session.get(f"http://127.0.0.1:{port}/_stats") as response:
+                run["server_requests"] = (await response.json())["requests"]
+            async with session.delete(f"http://127.0.0.1:{port}/_stats"):
+                pass
+            run["amplification"] = sum(run["server_requests"].values()) / (len(nodes) * len(groups))
+            runs.append(run)
+    return runs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmark against a local fake cluster')
+    parser.add_argument('--nodes', type=int, default=1000, help="Number of nodes of the fake cluster")
+    parser.add_argument('--groups', type=int, default=1, help="Number of groups of each run")
+    parser.add_argument('--actions', type=str, default="create_group,delete_group",
+                        help="Comma separated actions to run one after the other")
+    parser.add_argument('--latency', type=str, default="fixed:0",
+                        help="Latency of the fake nodes: fixed:<s>, uniform:<min>,<max> or exponential:<mean>")
+    parser.add_argument('--failure-rate', type=float, default=0, help="Ratio of requests answered with a 500")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the fake cluster")
+    parser.add_argument('--slow-nodes', type=float, default=0, help="Ratio of slow nodes")
+    parser.add_argument('--slow-factor', type=float, default=10, help="Latency multiplier of the slow nodes")
+    parser.add_argument('--flaky-nodes', type=float, default=0, help="Ratio of flaky nodes")
+    parser.add_argument('--flaky-failure-rate', type=float, default=0.5, help="Failure rate of the flaky nodes")
+    parser.add_argument('--concurrency', type=int, default=100, help="Max requests in flight")
+    parser.add_argument('--pipeline', action='store_true', help="Run Coroutine in pipeline mode")
+    parser.add_argument('--fail-fast', action='store_true', help="Run Coroutine in fail fast mode")
+    parser.add_argument('--output', type=str, help="JSON file to save the results")
+    parser.add_argument('--compare', type=argparse.FileType('r'), help="Previous JSON results to compare with")
+    args = parser.parse_args()
+
+    process, port = start_fake_cluster({
+        "latency": args.latency, "failure_rate": args.failure_rate, "seed": args.seed, "slow_nodes": args.slow_nodes,
+        "slow_factor": args.slow_factor, "flaky_nodes": args.flaky_nodes, "flaky_failure_rate": args.flaky_failure_rate,
+    })
+    try:
+        runs = asyncio.run(benchmark(args, port))
+    finally:
+        process.terminate()
+
+    results = {"commit": git_commit(), "created_at": time.time(), "params": vars(args) | {"compare": None}, "runs": runs}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        compare(json.load(args.compare), results)
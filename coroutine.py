@@ -0,0 +1,495 @@
+import asyncio
+import logging
+import math
+from array import array
+from collections import defaultdict
+from collections.abc import Collection, Sequence
+from contextlib import nullcontext
+from enum import Enum
+
+from tenacity import RetryError
+
+from node import CreateGroup, DeleteGroup, NodeActionState, NodeSession, NodeTable
+
+logger = logging.getLogger(__name__)
+
+
+class CoroutineState(Enum):
+    STATE_FETCHED = 1
+    DONE = 2
+    ROLLED_BACK = 3
+    ERROR = 4
+
+
+class CoroutineResult():
+
+    def __init__(self, status, statuses, nodes, errors=None):
+        self.status = status
+        # group -> CoroutineState
+        self.statuses = statuses
+        # group -> NodeActionState name -> list of nodes
+        self.nodes = nodes
+        # group -> error messages of the run
+        self.errors = errors or {}
+
+    @classmethod
+    def from_coroutine(cls, coroutine):
+        return cls(coroutine.status, dict(coroutine.statuses), coroutine.nodes_by_state(),
+                   {group: list(errors) for group, errors in coroutine.errors.items()})
+
+    def to_dict(self):
+        return {
+            "status": self.status.name if self.status else None,
+            "groups": {
+                group: {"status": status.name if status else None, "nodes": self.nodes[group],
+                        "errors": self.errors.get(group, [])}
+                for group, status in self.statuses.items()
+            }
+        }
+
+
+def parse_waves(spec):
+    # "1,1%,10%,100%": 1 node, then up to 1% of them, then 10% and then the rest
+    waves = []
+    for wave in spec.split(","):
+        wave = wave.strip()
+        if wave.endswith("%"):
+            waves.append(float(wave[:-1]) / 100)
+        else:
+            waves.append(int(wave))
+        if waves[-1] <= 0:
+            raise ValueError(f"Waves must be positive: {wave}")
+    return waves
+
+
+class Tasks(Sequence):
+
+    # The rows of a NodeTable seen as NodeAction objects, each one is built when it is accessed
+
+    def __init__(self, table, class_, session):
+        self.table = table
+        self.class_ = class_
+        self.session = session
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self.class_.at(self.table, row, self.session)
+
+
+class Coroutine():
+
+    actions = {
+        "create_group": CreateGroup,
+        "delete_group": DeleteGroup
+    }
+
+    def __init__(self, action, nodes, group, session=None, concurrency=100, state=None, refresh=True, pipeline=False,
+                 fail_fast=False, waves=None, window=None):
+        # `group` can be a single group name or a list of them, all of them share the same run
+        self.groups = [group] if isinstance(group, str) else list(dict.fromkeys(group))
+        self.action = action
+        self.concurrency = concurrency
+        # Semaphore shared by several coroutines running at once on the same session, every request of them takes a
+        # slot of it, so together they stay within one window instead of one each
+        self.window = window
+        class_ = self.actions.get(action)
+        if not class_:
+            # TODO: Handle this exception in a better way
+            raise Exception()
+
+        # A single pooled session is shared by every node, unless one is injected
+        self._owns_session = session is None
+        self.session = session if session is not None else NodeSession(limit=concurrency or 0)
+
+        # The state of every task lives in a table, tasks are views of its rows.
+        # A collection of nodes gets its rows up front, any other iterable (a stream) is read as the first phase
+        # consumes it, so requests start with the first node and the nodes are never copied. Duplicates are dropped
+        self.table = NodeTable(self.groups)
+        self.tasks = Tasks(self.table, class_, self.session)
+        self._nodes = None
+        self._inventory_failed = False
+        if isinstance(nodes, Collection):
+            for node in nodes:
+                self.table.add_node(node)
+            for group_id in range(len(self.groups)):
+                for node_id in range(len(self.table.nodes)):
+                    self.table.add(node_id, group_id)
+        else:
+            self._nodes = nodes
+
+        # With a state and no refresh, nodes with a known state are not checked again
+        self.state = state
+        self.refresh = refresh
+
+        # Pipeline: no barrier between phases, each node moves to forward on its own
+        self.pipeline = pipeline
+        # Fail fast: the first error of a group cancels its requests in flight and skips its remaining nodes
+        self.fail_fast = fail_fast
+        # Waves: the nodes of each group are changed in steps, every one has to succeed before the next one starts.
+        # Each step is the total of nodes changed so far, a count (int) or a ratio of the nodes to change (float)
+        self.waves = waves
+
+        self._task_to_run = array("I")
+        self.statuses = {group: None for group in self.groups}
+        self.errors = {group: [] for group in self.groups}
+        self.status = None
+
+    def run(self):
+        return asyncio.get_event_loop().run_until_complete(self.run_async())
+
+    async def run_async(self):
+        journal = self.session.journal
+        try:
+            if journal is not None:
+                await journal.commit({"event": "run", "action": self.action, "groups": self.groups})
+            await self._run()
+            if journal is not None:
+                status = self._overall_status()
+                await journal.commit({"event": "end", "status": status.name if status else None})
+        finally:
+            if self._owns_session:
+                await self.session.close()
+            if self.state is not None:
+                self.state.save()
+        self.status = self._overall_status()
+        return CoroutineResult.from_coroutine(self)
+
+    def nodes_by_state(self):
+        return self.table.nodes_by_state()
+
+    def plan(self):
+        plan = {"change": [], "unchanged": [], "unknown": []}
+        for task in self._all_tasks():
+            if not self._status_from_state(task):
+                plan["unknown"].append(task)
+            elif task.status == NodeActionState.READY:
+                plan["change"].append(task)
+            else:
+                plan["unchanged"].append(task)
+        return plan
+
+    async def _run(self):
+        if self.pipeline:
+            # 1-2. Every node runs the desired action as soon as its own status is fetched
+            with self._phase("pipeline"):
+                failed, ran, errors = await self._pipeline_phase()
+        else:
+            # 1. Get status of all nodes
+            with self._phase("status"):
+                failed = await self._status_phase()
+            await self._journal_planned(failed)
+
+            # 2. Run the desired action
+            with self._phase("forward"):
+                ran, errors = await self._forward_phase(failed)
+
+        for group in failed:
+            logger.error(f"Unable to get current status of {group}")
+            self.statuses[group] = CoroutineState.ERROR
+            self.errors[group].append(f"Unable to get current status of {group}")
+
+        for group in ran - errors.keys() - failed:
+            self.statuses[group] = CoroutineState.DONE
+            logger.info(f"Done {group}")
+
+        for group, group_errors in errors.items():
+            logger.error(group_errors)
+            self.errors[group].extend(group_errors)
+            logger.warning(f"Unable to perform updates of {group}. Rolling back")
+
+        # Rollback is scoped to the groups that failed, the others are kept
+        to_rollback = errors.keys() | failed
+        if not to_rollback:
+            return
+
+        # 2.1 Rollback in case of errors
+        with self._phase("rollback"):
+            rolled_back, rollback_errors = await self._rollback_phase(to_rollback)
+        for group in errors.keys() | rolled_back:
+            if group in rollback_errors:
+                self.statuses[group] = CoroutineState.ERROR
+                logger.error(rollback_errors[group])
+                self.errors[group].extend(rollback_errors[group])
+                logger.critical(f"Error, Rollback of {group} failed, a manual check is needed")
+            else:
+                if group not in failed:
+                    self.statuses[group] = CoroutineState.ROLLED_BACK
+                logger.info(f"Rollback of {group} was successful")
+
+    # Each phase only exchanges group names and error messages, so a coordinator can run them on several processes
+
+    async def _status_phase(self):
+        task_to_check = array("I")
+        errors = await self._get_status(self._collect(self._tasks_to_check(), task_to_check))
+        self._record_state(task_to_check)
+        return set(self.groups) if self._inventory_failed else self.table.groups_of(errors)
+
+    async def _forward_phase(self, failed):
+        to_run = {group: self.table.select([NodeActionState.READY], groups={group})
+                  for group in self.groups if group not in failed}
+        waves = {group: self._wave_ends(len(rows)) for group, rows in to_run.items()}
+        self._task_to_run = array("I")
+        errors = {}
+        # A failing group stops at its current wave, so only the nodes changed so far are rolled back
+        for wave in range(max(map(len, waves.values()), default=0)):
+            stopped = self.table.groups_of(errors)
+            rows = array("I")
+            for group, ends in waves.items():
+                if wave < len(ends) and group not in stopped:
+                    rows.extend(to_run[group][ends[wave - 1] if wave else 0:ends[wave]])
+            if not rows:
+                break
+            if self.waves:
+                logger.info(f"Wave {wave + 1}: {len(rows)} nodes")
+            self._task_to_run.extend(rows)
+            errors.update(await self._forward(self._tasks(self._schedule(rows))))
+        self._record_state(self._task_to_run)
+        return self.table.groups_of(self._task_to_run), self._errors_by_group(errors)
+
+    async def _journal_planned(self, failed):
+        # The nodes to change are on disk before the first change, so a resume also finishes the ones never reached
+        journal = self.session.journal
+        if journal is None:
+            return
+        await journal.commit({"event": "planned", "nodes": {
+            group: [self.table.node(row) for row in self.table.select([NodeActionState.READY], groups={group})]
+            for group in self.groups if group not in failed
+        }})
+
+    def _wave_ends(self, total):
+        ends = []
+        for wave in self.waves or ():
+            end = min(total, math.ceil(wave * total) if isinstance(wave, float) else wave)
+            if end > (ends[-1] if ends else 0):
+                ends.append(end)
+        if total and (not ends or ends[-1] < total):
+            ends.append(total)
+        return ends
+
+    async def _pipeline_phase(self):
+        failed, task_to_check, self._task_to_run, errors = await self._pipeline()
+        self._record_state(task_to_check)
+        self._record_state(self._task_to_run)
+        if self._inventory_failed:
+            failed = set(self.groups)
+        return failed, self.table.groups_of(self._task_to_run), self._errors_by_group(errors)
+
+    async def _rollback_phase(self, groups):
+        task_to_rollback = self.table.select([NodeActionState.DONE, NodeActionState.UNKNOWN], groups=groups,
+                                             rows=self._task_to_run)
+        errors = await self._backward(self._tasks(self._schedule(task_to_rollback)))
+        self._record_state(task_to_rollback)
+        return self.table.groups_of(task_to_rollback), self._errors_by_group(errors)
+
+    def _tasks(self, rows):
+        return (self.tasks[row] for row in rows)
+
+    def _all_tasks(self):
+        return iter(self.tasks) if self._nodes is None else self._load_tasks()
+
+    def _scheduled_tasks(self):
+        # A stream of nodes runs in the order it is read
+        return self._tasks(self._schedule(range(len(self.table)))) if self._nodes is None else self._load_tasks()
+
+    def _schedule(self, rows):
+        # The slowest and least reliable nodes start first, so they do not stretch the end of the phase
+        scoreboard = self.session.scoreboard
+        if scoreboard is not None:
+            scores = scoreboard.scores(self.table.nodes)
+            node_ids = self.table.node_ids
+            rows = sorted(rows, key=lambda row: scores[node_ids[row]], reverse=True)
+        # Nothing to spread with a single origin or an origin per node
+        return self._interleave(rows) if 1 < len(self.table.origins) < len(self.table.nodes) else rows
+
+    def _interleave(self, rows):
+        # Round robin across origins, the nodes sharing a host are spread along the phase instead of sent in a row:
+        # the first node of every origin, then the second one and so on
+        node_origins, node_ids = self.table.node_origins, self.table.node_ids
+        seen = array("I", bytes(4 * len(self.table.origins)))
+        rounds = array("I")
+        for row in rows:
+            origin = node_origins[node_ids[row]]
+            rounds.append(seen[origin])
+            seen[origin] += 1
+        rows = list(rows)
+        return [rows[i] for i in sorted(range(len(rows)), key=rounds.__getitem__)]
+
+    def _load_tasks(self):
+        nodes, self._nodes = self._nodes, None
+        try:
+            for node in nodes:
+                node_id = self.table.add_node(node)
+                if node_id is None:
+                    continue
+                for group_id in range(len(self.groups)):
+                    yield self.tasks[self.table.add(node_id, group_id)]
+        except Exception as e:
+            # The nodes read so far may have been changed already, so a broken inventory fails every group
+            logger.error(f"Unable to read the nodes: {e}")
+            self._inventory_failed = True
+
+    def _tasks_to_check(self):
+        return (task for task in self._scheduled_tasks() if self._needs_check(task))
+
+    def _needs_check(self, task):
+        return self.state is None or self.refresh or not self._status_from_state(task)
+
+    @staticmethod
+    def _collect(tasks, rows):
+        for task in tasks:
+            rows.append(task.row)
+            yield task
+
+    def _phase(self, name):
+        metrics = self.session.metrics
+        return metrics.phase(name) if metrics is not None else nullcontext()
+
+    def _status_from_state(self, task):
+        present = self.state.get(task.node, task.group)
+        if present is None:
+            return False
+        task.status = NodeActionState.NOT_NEEDED if present == task.present_when_done else NodeActionState.READY
+        return True
+
+    def _record_state(self, rows):
+        if self.state is None:
+            return
+        for task in self._tasks(rows):
+            if task.status in (NodeActionState.DONE, NodeActionState.NOT_NEEDED):
+                self.state.set(task.node, task.group, task.present_when_done)
+            elif task.status in (NodeActionState.READY, NodeActionState.ROLLED_BACK):
+                self.state.set(task.node, task.group, not task.present_when_done)
+            else:
+                self.state.forget(task.node, task.group)
+
+    def _overall_status(self):
+        statuses = set(self.statuses.values())
+        for status in (CoroutineState.ERROR, CoroutineState.ROLLED_BACK, CoroutineState.DONE):
+            if status in statuses:
+                return status
+        return None
+
+    def _errors_by_group(self, errors):
+        errors_by_group = defaultdict(list)
+        for row, error in sorted(errors.items()):
+            errors_by_group[self.table.group(row)].append(
+                str(error.last_attempt.exception() if isinstance(error, RetryError) else error))
+        return errors_by_group
+
+    async def _get_status(self, tasks):
+        return await self._execute(tasks, lambda task: task.get_current_status(task.group), fail_fast=self.fail_fast)
+
+    async def _forward(self, tasks):
+        return await self._execute(tasks, lambda task: task.forward(task.group), fail_fast=self.fail_fast)
+
+    async def _backward(self, tasks):
+        return await self._execute(tasks, self._rollback)
+
+    @classmethod
+    async def _rollback(cls, task):
+        # A cancelled node is only rolled back if the change actually reached it
+        if task.status == NodeActionState.UNKNOWN:
+            await cls._probe(task)
+            if task.status == NodeActionState.READY:
+                return
+        return await task.backward(task.group)
+
+    @staticmethod
+    async def _probe(task):
+        # Always asked to the node, a cached status may be older than a change cut short
+        task._remember(task.group, None)
+        await task.get_current_status(task.group)
+
+    async def _pipeline(self):
+        # Nodes whose status comes from the state skip straight to forward
+        task_to_check = array("I")
+        task_to_run = array("I")
+        failed = set()
+        stopped = set()
+        forward_errors = set()
+
+        async def check_and_forward(task):
+            if self._needs_check(task):
+                task_to_check.append(task.row)
+                try:
+                    await task.get_current_status(task.group)
+                except Exception:
+                    failed.add(task.group)
+                    stopped.add(task.group)
+                    raise
+            # Once a group is failing there is no point on changing more nodes of it
+            if task.status == NodeActionState.READY and task.group not in stopped:
+                task_to_run.append(task.row)
+                try:
+                    return await task.forward(task.group)
+                except Exception:
+                    forward_errors.add(task.row)
+                    stopped.add(task.group)
+                    raise
+
+        errors = await self._execute(self._scheduled_tasks(), check_and_forward, fail_fast=self.fail_fast)
+        # Rows were added as their requests started, the table order is restored for the next phases
+        task_to_run = array("I", sorted(task_to_run))
+        return failed, task_to_check, task_to_run, {row: errors[row] for row in forward_errors if row in errors}
+
+    async def _execute(self, tasks, step, fail_fast=False):
+        # Sliding window: a fixed number of workers pull the next node as soon as one finishes,
+        # so at most `concurrency` requests are in flight at any time. `tasks` can be a generator, it is only
+        # advanced when a worker is free. Returns the exception of each failed task by row
+        if not self.concurrency:
+            tasks = list(tasks)
+        if self.window is not None:
+            step = self._windowed(step)
+        errors = {}
+        pending = iter(tasks)
+        in_flight = {}
+        stopped = set()
+
+        async def worker():
+            for task in pending:
+                if task.group in stopped:
+                    continue
+                if not fail_fast:
+                    # Nothing cancels a single request, it runs in the worker itself instead of a task of its own
+                    try:
+                        await step(task)
+                    except Exception as e:
+                        errors[task.row] = e
+                    continue
+                current = asyncio.ensure_future(step(task))
+                in_flight[task.row] = (task, current)
+                try:
+                    await asyncio.wait({current})
+                except asyncio.CancelledError:
+                    current.cancel()
+                    raise
+                finally:
+                    del in_flight[task.row]
+
+                if current.cancelled():
+                    task.status = NodeActionState.UNKNOWN
+                elif current.exception() is not None:
+                    errors[task.row] = current.exception()
+                    if fail_fast and task.group not in stopped:
+                        stopped.add(task.group)
+                        for other, request in in_flight.values():
+                            if other.group == task.group:
+                                request.cancel()
+
+        workers = min(self.concurrency, len(tasks)) if isinstance(tasks, Collection) else self.concurrency
+        await asyncio.gather(*[worker() for _ in range(workers or len(tasks))])
+        return errors
+
+    def _windowed(self, step):
+        async def windowed(task):
+            async with self.window:
+                return await step(task)
+        return windowed
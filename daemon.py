@@ -0,0 +1,193 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, defaultdict
+
+from aiohttp import web
+
+from coroutine import Coroutine, CoroutineState
+
+logger = logging.getLogger(__name__)
+
+
+class Job():
+
+    def __init__(self, id, action, nodes, groups):
+        self.id = id
+        self.action = action
+        self.nodes = nodes
+        self.groups = groups
+        self.created_at = time.time()
+        self.status = None
+        # group -> node state name -> list of nodes, SUPERSEDED for the nodes a later job took over
+        self.nodes_by_state = {group: defaultdict(list) for group in groups}
+        self.errors = []
+        self.done = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "action": self.action,
+            "status": self.status or "PENDING",
+            "groups": {group: dict(nodes) for group, nodes in self.nodes_by_state.items()},
+            "errors": self.errors,
+        }
+
+
+class Daemon():
+
+    # Jobs are queued for `batch_window` seconds and run together as one batch: the same (node, group) asked by several
+    # jobs is only changed once, the last job wins. Batches run one after the other on the same session, so the
+    # connections, the circuit breakers and the status cache stay warm between jobs
+
+    def __init__(self, session, concurrency=100, batch_window=0.05, pipeline=False, fail_fast=False, max_jobs=1000):
+        self.session = session
+        self.concurrency = concurrency
+        self.batch_window = batch_window
+        self.pipeline = pipeline
+        self.fail_fast = fail_fast
+        self.max_jobs = max_jobs
+        # (node, group) -> (action, job) of the next batch
+        self.pending = {}
+        self.waiting = []
+        # Latest jobs by id, the oldest finished ones are dropped past max_jobs
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._wake = None
+        self._runner = None
+
+    def submit(self, action, nodes, groups):
+        if action not in Coroutine.actions:
+            raise ValueError(f"Unknown action: {action}")
+        for name, values in (("nodes", nodes), ("group", groups)):
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"{name} must be a list of strings")
+        job = Job(next(self._ids), action, list(dict.fromkeys(nodes)), list(dict.fromkeys(groups)))
+        for group in job.groups:
+            for node in job.nodes:
+                self.pending[(node, group)] = (action, job)
+        self.waiting.append(job)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_jobs and next(iter(self.jobs.values())).done.is_set():
+            self.jobs.popitem(last=False)
+        self._wake.set()
+        return job
+
+    async def run_forever(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.batch_window)
+            self._wake.clear()
+            batch, self.pending = self.pending, {}
+            jobs, self.waiting = self.waiting, []
+            try:
+                await self._run_batch(batch, jobs)
+            except Exception as e:
+                # The jobs of the batch fail, the next batches still run
+                logger.exception("Batch failed")
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.status = CoroutineState.ERROR.name
+                        job.errors.append(str(e) or e.__class__.__name__)
+                        job.done.set()
+
+    async def _run_batch(self, batch, jobs):
+        nodes = defaultdict(list)
+        for (node, group), (action, job) in batch.items():
+            nodes[(action, group)].append(node)
+        logger.info(f"Batch of {len(jobs)} jobs: {len(batch)} nodes in {len(nodes)} runs")
+
+        # The runs of a batch go on at the same time on one pool, they share a single window of requests in flight
+        window = asyncio.Semaphore(self.concurrency) if self.concurrency else None
+        results = await asyncio.gather(*[self._run(action, group_nodes, group, window)
+                                         for (action, group), group_nodes in nodes.items()], return_exceptions=True)
+
+        # (action, group) -> node -> state name, and the status and error messages of each run
+        states = {}
+        statuses = {}
+        for key, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.exception(f"Run of {key} failed", exc_info=result)
+                states[key] = {}
+                statuses[key] = (CoroutineState.ERROR, [str(result)])
+                continue
+            states[key] = {node: state for state, group_nodes in result.nodes[key[1]].items() for node in group_nodes}
+            # Nothing to change is as good as done
+            statuses[key] = (result.statuses[key[1]] or CoroutineState.DONE, result.errors.get(key[1], []))
+
+        for job in jobs:
+            job_statuses = set()
+            for group in job.groups:
+                for node in job.nodes:
+                    action, owner = batch[(node, group)]
+                    if owner is not job:
+                        job.nodes_by_state[group]["SUPERSEDED"].append(node)
+                        continue
+                    job.nodes_by_state[group][states[(action, group)].get(node, "PENDING")].append(node)
+                    status, errors = statuses[(action, group)]
+                    job_statuses.add(status)
+                    for error in errors:
+                        if error not in job.errors:
+                            job.errors.append(error)
+            job.status = "SUPERSEDED" if job.nodes and job.groups else CoroutineState.DONE.name
+            for status in (CoroutineState.ERROR, CoroutineState.ROLLED_BACK, CoroutineState.DONE):
+                if status in job_statuses:
+                    job.status = status.name
+                    break
+            job.done.set()
+
+    async def _run(self, action, group_nodes, group, window):
+        # Built inside the gather, a run that can not even start only fails its own jobs
+        coroutine = Coroutine(action, group_nodes, group, session=self.session, concurrency=self.concurrency,
+                              pipeline=self.pipeline, fail_fast=self.fail_fast, window=window)
+        return await coroutine.run_async()
+
+    async def create_job(self, request):
+        try:
+            data = await request.json()
+            groups = data["group"]
+            job = self.submit(data["action"], data["nodes"], [groups] if isinstance(groups, str) else groups)
+        except (ValueError, KeyError, TypeError) as e:
+            return web.json_response({"error": f"Invalid job: {e!r}"}, status=400)
+        if data.get("wait"):
+            await job.done.wait()
+        return web.json_response(job.to_dict(), status=200 if job.done.is_set() else 202)
+
+    async def get_job(self, request):
+        job = self.jobs.get(int(request.match_info["id"]))
+        if job is None:
+            return web.json_response({"error": "Job not found"}, status=404)
+        if "wait" in request.query:
+            await job.done.wait()
+        return web.json_response(job.to_dict())
+
+    async def health(self, request):
+        now = asyncio.get_running_loop().time()
+        return web.json_response({
+            "pending_nodes": len(self.pending),
+            "jobs": len(self.jobs),
+            "open_circuits": sorted(node for node, breaker in self.session.breakers.items()
+                                    if breaker.opened_at is not None and now - breaker.opened_at < breaker.cooldown),
+        })
+
+    async def _start(self, app):
+        self._wake = asyncio.Event()
+        self._runner = asyncio.ensure_future(self.run_forever())
+
+    async def _stop(self, app):
+        self._runner.cancel()
+        try:
+            await self._runner
+        except asyncio.CancelledError:
+            pass
+        await self.session.close()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/jobs", self.create_job)
+        app.router.add_get("/jobs/{id:\\d+}", self.get_job)
+        app.router.add_get("/health", self.health)
+        app.on_startup.append(self._start)
+        app.on_cleanup.append(self._stop)
+        return app
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import re
+from array import array
+from itertools import chain
+
+CHUNK_SIZE = 1 << 16
+
+WHITESPACE = re.compile(r"\s*")
+# Characters allowed in a URL, a plain line with anything else is not a node
+URL = re.compile(r"[A-Za-z0-9\-._~:/?#\[\]@!$&'()*+,;=%]+")
+
+
+class InventoryError(ValueError):
+    pass
+
+
+class NodeSet():
+
+    # Open addressing table of 64 bit hashes of the nodes in a list, with the index of each node in it. A node added
+    # is appended to the list and nothing else is copied: a matching hash is checked against the node in the list, so
+    # two nodes sharing a hash are both kept
+
+    def __init__(self, nodes=None, capacity=1024):
+        self.nodes = [] if nodes is None else nodes
+        self.slots = array("Q", bytes(8 * capacity))
+        # Slot -> index + 1
+        self.entries = array("I", bytes(4 * capacity))
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def hash(node):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.blake2b(node, digest_size=8).digest(), "big") or 1
+
+    def add(self, node):
+        # True when the node was not in the set yet
+        value = self.hash(node.encode())
+        mask = len(self.slots) - 1
+        i = value & mask
+        while self.slots[i]:
+            if self.slots[i] == value and self.nodes[self.entries[i] - 1] == node:
+                return False
+            i = (i + 1) & mask
+        self.nodes.append(node)
+        self.slots[i] = value
+        self.entries[i] = len(self.nodes)
+        self._count += 1
+        if self._count * 2 > len(self.slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        slots, entries = self.slots, self.entries
+        self.slots = array("Q", bytes(16 * len(slots)))
+        self.entries = array("I", bytes(8 * len(entries)))
+        mask = len(self.slots) - 1
+        for value, entry in zip(slots, entries):
+            if value:
+                i = value & mask
+                while self.slots[i]:
+                    i = (i + 1) & mask
+                self.slots[i] = value
+                self.entries[i] = entry
+
+
+def unique(nodes):
+    seen = NodeSet()
+    for node in nodes:
+        if seen.add(node):
+            yield node
+
+
+def read_nodes(f, chunk_size=CHUNK_SIZE):
+    # A JSON list of strings, JSON lines with a string each or one node per line, read as the nodes are consumed.
+    # The format is guessed from the first character, so a broken root element is reported before any node is read
+    head = f.read(chunk_size)
+    first = head.lstrip()[:1]
+    if first == "[":
+        return _json_list(head, f, chunk_size)
+    if first == "{" or _is_json_scalar(head):
+        raise InventoryError("Root element must be a list")
+    lines = chain(head.splitlines(keepends=True), f) if head.endswith("\n") else _lines(head, f)
+    return _json_lines(lines) if first == '"' else _plain_lines(lines)
+
+
+def _is_json_scalar(head):
+    # A number, true, false or null as the whole first line, a host like 10.0.0.1 or null.example.com is not one
+    line = head.lstrip().split("\n", 1)[0].strip()
+    try:
+        value, end = json.JSONDecoder().raw_decode(line)
+    except json.decoder.JSONDecodeError:
+        return False
+    return end == len(line) and not isinstance(value, str)
+
+
+def _lines(head, f):
+    # The first line may have been cut by the first read
+    lines = head.splitlines(keepends=True)
+    if not lines:
+        return
+    yield from lines[:-1]
+    yield lines[-1] + f.readline()
+    yield from f
+
+
+def _plain_lines(lines):
+    for line in lines:
+        node = line.strip()
+        if not node:
+            continue
+        if not URL.fullmatch(node):
+            raise InventoryError(f"Node is not a URL: {node[:100]!r}")
+        yield node
+
+
+def _json_lines(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            node = json.loads(line)
+        except json.decoder.JSONDecodeError:
+            raise InventoryError("File can not be readed")
+        if not isinstance(node, str):
+            raise InventoryError("Nodes must be a string")
+        yield node
+
+
+def _json_list(buffer, f, chunk_size):
+    decoder = json.JSONDecoder()
+    position = WHITESPACE.match(buffer).end() + 1
+    expect_value = True
+    first = True
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position < len(buffer):
+            if expect_value and not (first and buffer[position] == "]"):
+                try:
+                    node, end = decoder.raw_decode(buffer, position)
+                except json.decoder.JSONDecodeError:
+                    # The value may continue in the next chunk
+                    end = None
+                if end is not None and end < len(buffer):
+                    if not isinstance(node, str):
+                        raise InventoryError("Nodes must be a string")
+                    yield node
+                    position, expect_value, first = end, False, False
+                    continue
+            elif buffer[position] == "]":
+                return
+            elif buffer[position] == ",":
+                position, expect_value = position + 1, True
+                continue
+            else:
+                raise InventoryError("File can not be readed")
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise InventoryError("File can not be readed")
+        buffer = buffer[position:] + chunk
+        position = 0
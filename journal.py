@@ -0,0 +1,178 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+
+from coroutine import Coroutine, CoroutineState
+from node import NodeActionState
+
+logger = logging.getLogger(__name__)
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal():
+
+    # Append only JSON lines: a "run" record, a "planned" record with the nodes to change of each group, a "start"
+    # record before each forward or backward request and a "done" or "error" record after it, and an "end" record when
+    # the run is over. A start record is on disk before its request
+    # is sent. Records appended while a write is in flight go to disk together with the next write, so concurrent
+    # requests share one fsync
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._file = open(path, "a" if append else "w")
+        self._buffer = []
+        self._appended = 0
+        self._synced = 0
+        self._syncing = None
+        self._error = None
+
+    def append(self, record):
+        # Written soon, but nothing waits for it
+        self._buffer.append(json.dumps(record, separators=(",", ":")))
+        self._appended += 1
+        if self._syncing is None:
+            self._sync()
+
+    async def commit(self, record):
+        self.append(record)
+        await self.flush()
+
+    async def flush(self):
+        target = self._appended
+        while self._synced < target:
+            if self._error is not None:
+                raise JournalError(f"Unable to write the journal {self.path}: {self._error!r}")
+            if self._syncing is None:
+                self._sync()
+            # Shielded, a cancelled writer does not cancel the write of everyone else
+            await asyncio.shield(self._syncing)
+
+    async def close(self):
+        await self.flush()
+        self._file.close()
+
+    def _sync(self):
+        lines, self._buffer = self._buffer, []
+        self._syncing = asyncio.ensure_future(self._write_lines(lines, self._appended))
+
+    async def _write_lines(self, lines, appended):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+        except Exception as e:
+            # Raised as a JournalError to every writer waiting for it
+            self._error = e
+        else:
+            self._synced = appended
+        finally:
+            self._syncing = None
+
+    def _write(self, lines):
+        self._file.write("".join(f"{line}\n" for line in lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def load(path):
+    # Action and groups of the journaled run, the last record of each (node, group), the nodes planned to change by
+    # group and whether the run ended
+    run = None
+    operations = {}
+    planned = {}
+    ended = False
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                # The last line is cut when the process died while writing it
+                break
+            event = record["event"]
+            if event == "run":
+                run = run or record
+                ended = False
+            elif event == "end":
+                ended = True
+            elif event == "planned":
+                # A resume plans the nodes left, the first run planned them all
+                for group, nodes in record["nodes"].items():
+                    planned.setdefault(group, {}).update(dict.fromkeys(nodes))
+            else:
+                operations[(record["node"], record["group"])] = (record["op"], event)
+    if run is None:
+        raise JournalError(f"No run in the journal {path}")
+    return run, operations, planned, ended
+
+
+class ResumedCoroutine(Coroutine):
+
+    # Picks up an interrupted run from its journal. Nodes changed are rolled back or kept, the ones with an unknown
+    # outcome and the planned ones never reached are checked first. A group that was already rolling back or had
+    # failures is rolled back, the others are finished unless `rollback` is set. A group without a planned record,
+    # like the ones of a pipeline run, can not be finished: its nodes never reached are unknown, so it ends in ERROR
+
+    def __init__(self, path, session, rollback=False, concurrency=100):
+        run, operations, planned, self.ended = load(path)
+        nodes = list(dict.fromkeys(itertools.chain((node for node, group in operations),
+                                                   (node for group in planned.values() for node in group))))
+        super().__init__(run["action"], nodes, run["groups"], session=session, concurrency=concurrency)
+        self.unplanned = set() if self.ended else set(self.groups) - planned.keys()
+
+        self.to_rollback = set(self.groups) if rollback else set()
+        rows = {(self.table.node(row), self.table.group(row)): row for row in range(len(self.table))}
+        if not self.ended:
+            for group, group_nodes in planned.items():
+                for node in group_nodes:
+                    self.table.set_status(rows[(node, group)], NodeActionState.READY)
+        for (node, group), (operation, event) in operations.items():
+            if operation == "backward" or event == "error":
+                self.to_rollback.add(group)
+            if operation == "forward" and event == "done":
+                self.table.set_status(rows[(node, group)], NodeActionState.DONE)
+            elif operation == "backward" and event == "done":
+                self.table.set_status(rows[(node, group)], NodeActionState.ROLLED_BACK)
+            else:
+                # Started but not finished or failed: the change may or may not be on the node
+                self.table.set_status(rows[(node, group)], NodeActionState.UNKNOWN)
+
+    async def run_async(self):
+        if self.ended:
+            logger.info("The journaled run is over, there is nothing to resume")
+        return await super().run_async()
+
+    async def _status_phase(self):
+        if self.ended:
+            return set()
+        groups = set(self.groups) - self.to_rollback
+        unknown = self.table.select([NodeActionState.UNKNOWN], groups=groups)
+        # Asked to the nodes: a cached status and the one of the nodes never reached are as old as the interrupted run
+        errors = await self._execute(self._tasks(self.table.select([NodeActionState.UNKNOWN, NodeActionState.READY],
+                                                                   groups=groups)), self._probe)
+        for row in unknown:
+            # The interrupted change did reach the node
+            if self.table.statuses[row] == NodeActionState.NOT_NEEDED.value:
+                self.table.set_status(row, NodeActionState.DONE)
+        return self.table.groups_of(errors)
+
+    async def _forward_phase(self, failed):
+        if self.ended:
+            return set(), {}
+        ran, errors = await super()._forward_phase(failed | self.to_rollback)
+        # The rollback covers the changes of the interrupted run too
+        self._task_to_run = self.table.select([NodeActionState.DONE, NodeActionState.UNKNOWN])
+        ran |= self.table.groups_of(self._task_to_run)
+        for group in self.to_rollback - failed:
+            errors[group].append("Resumed with a rollback")
+        return ran, errors
+
+    async def _run(self):
+        await super()._run()
+        for group in self.unplanned:
+            if self.statuses[group] == CoroutineState.DONE:
+                logger.error(f"Nodes of {group} not reached by the interrupted run are unknown, run it again")
+                self.statuses[group] = CoroutineState.ERROR
+                self.errors[group].append("Nodes not reached by the interrupted run are unknown")
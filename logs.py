@@ -0,0 +1,70 @@
+import json
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s: %(message)s'
+
+# Structured records of each node operation, one JSON object per line. They are logged at INFO level,
+# so they are off until setup_logging is given a destination for them
+events = logging.getLogger("events")
+events.propagate = False
+events.setLevel(logging.WARNING)
+
+
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        # QueueHandler formats the record before queueing it, here it is left to the listener thread
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps({"time": record.created, **record.event}, separators=(",", ":"))
+
+
+class Logging():
+
+    def __init__(self):
+        self.listeners = []
+
+    def add(self, logger, handler, level):
+        queue = SimpleQueue()
+        queue_handler = DeferredQueueHandler(queue)
+        logger.addHandler(queue_handler)
+        previous_level = logger.level
+        logger.setLevel(level)
+        listener = QueueListener(queue, handler)
+        listener.start()
+        self.listeners.append((logger, previous_level, queue_handler, listener))
+
+    def stop(self):
+        # Writes everything queued so far
+        for logger, previous_level, queue_handler, listener in self.listeners:
+            logger.removeHandler(queue_handler)
+            logger.setLevel(previous_level)
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        self.listeners = []
+
+
+def _handler(destination):
+    return logging.StreamHandler(sys.stderr) if destination == "-" else logging.FileHandler(destination)
+
+
+def setup_logging(level="DEBUG", destination="/tmp/run.log", events_destination=None):
+    # Records are written by background threads so file I/O never blocks the event loop
+    setup = Logging()
+    handler = _handler(destination)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    setup.add(logging.getLogger(), handler, level)
+    if events_destination:
+        handler = _handler(events_destination)
+        handler.setFormatter(JsonLinesFormatter())
+        setup.add(events, handler, logging.INFO)
+    return setup
@@ -1,123 +1,327 @@
 import asyncio
 import logging
-from enum import Enum
 
-from node import CreateGroup, DeleteGroup, NodeActionState
+from coroutine import Coroutine, CoroutineState, parse_waves
+from inventory import InventoryError, read_nodes
+from node import NodeSession, RetryPolicy
+from logs import setup_logging
+from metrics import Metrics
+from scoreboard import Scoreboard
+from state import ClusterState, StatusCache
 
-
-logging.basicConfig(filename='/tmp/run.log', format='%(asctime)s - %(levelname)s: %(message)s', level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-class CoroutineState(Enum):
-    STATE_FETCHED = 1
-    DONE = 2
-    ROLLED_BACK = 3
-    ERROR = 4
-
-
-class Coroutine():
-
-    actions = {
-        "create_group": CreateGroup,
-        "delete_group": DeleteGroup
-    }
-
-    def __init__(self, action, nodes, group):
-        self.group = group
-        class_ = self.actions.get(action)
-        if not class_:
-            # TODO: Handle this exception in a better way
-            raise Exception()
-
-        # TODO: Implement a creational pattern
-        self.tasks = [class_(node) for node in nodes]
-
-        self.status = None
-
-    def run(self):
-        loop = asyncio.get_event_loop()
-
-        # 1. Get status of all nodes
-        result = loop.run_until_complete(self._get_status(self.tasks))
-        errors = [i for i in result if isinstance(i, Exception)]
-        if errors:
-            logger.error("Unable to get current status")
-            self.status = CoroutineState.ERROR
-            return
-
-        task_to_run = [task for task in self.tasks if task.status == NodeActionState.READY]
-
-        # 2. Run the desired action
-        if task_to_run:
-            result = loop.run_until_complete(self._forward(task_to_run))
-            errors = [str(i.last_attempt.exception()) for i in result if isinstance(i, Exception)]
-            if errors:
-                logger.error(errors)
-                logger.warning("Unable to perform updates. Rolling back")
-
-                task_to_rollback = [task for task in self.tasks if task.status == NodeActionState.DONE]
-
-                # 2.1 Rollback in case of errors
-                result = loop.run_until_complete(self._backward(task_to_rollback))
-                errors = [str(i.last_attempt.exception()) for i in result if isinstance(i, Exception)]
-                if errors:
-                    self.status = CoroutineState.ERROR
-                    logger.error(errors)
-                    logger.critical("Error, Rollback failed, a manual check is needed")
-                else:
-                    self.status = CoroutineState.ROLLED_BACK
-                    logger.info("Rollback was successful")
-            else:
-                self.status = CoroutineState.DONE
-                logger.info("Done")
-
-    async def _get_status(self, tasks):
-        result = await asyncio.gather(
-                      *[asyncio.create_task(task.get_current_status(self.group)) for task in tasks],
-                      return_exceptions=True
-                  )
-        return result
-
-    async def _forward(self, tasks):
-        result = await asyncio.gather(
-                      *[asyncio.create_task(task.forward(self.group)) for task in tasks],
-                      return_exceptions=True
-                  )
-        return result
-
-    async def _backward(self, tasks):
-        result = await asyncio.gather(
-                      *[asyncio.create_task(task.backward(self.group)) for task in tasks],
-                      return_exceptions=True
-                  )
-        return result
+def non_negative_int(value):
+    # Limits where 0 means no limit
+    value = int(value)
+    if value < 0:
+        raise ValueError(f"Must be 0 or more: {value}")
+    return value
 
 
 if __name__ == '__main__':
     import argparse
-    import json
+    import aiohttp
     import sys
 
+    def add_target_arguments(parser):
+        parser.add_argument('group_name', type=str, nargs='?',
+                            help='Group name, a comma separated list of groups or @file with one group per line')
+        parser.add_argument('node_file', nargs='?', type=argparse.FileType('r'),
+                            help="Nodes urls: a JSON list of strings, JSON lines or one url per line, - for stdin")
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--concurrency', type=non_negative_int, default=100,
+                         help="Max requests in flight at the same time (0 means no limit)")
+    options.add_argument('--keepalive', type=float, default=15,
+                         help="Seconds an idle connection is kept open for reuse")
+    options.add_argument('--limit-per-host', type=non_negative_int, default=0,
+                         help="Max simultaneous connections to the same host (0 means no limit)")
+    options.add_argument('--origin-concurrency', type=non_negative_int, default=0,
+                         help="Max requests in flight to each scheme://host:port, shared by all its nodes (0 means no limit)")
+    options.add_argument('--http2', action='store_true',
+                         help="Send the requests over HTTP/2, multiplexed on one connection per origin (needs httpx[http2])")
+    options.add_argument('--dns-ttl', type=int, default=300,
+                         help="Seconds DNS resolutions are cached")
+    options.add_argument('--backoff', type=float, default=0.1,
+                         help="Base seconds of the exponential backoff (with jitter) between retries")
+    options.add_argument('--max-backoff', type=float, default=5,
+                         help="Max seconds to wait between retries")
+    options.add_argument('--retry-budget', type=float, default=0.2,
+                         help="Max retries as a ratio of the requests done in the run")
+    options.add_argument('--breaker-threshold', type=int, default=5,
+                         help="Consecutive failures after which a node is not contacted anymore")
+    options.add_argument('--breaker-cooldown', type=float, default=30,
+                         help="Seconds before contacting again a node after its circuit opened")
+    options.add_argument('--connect-timeout', type=float, default=5,
+                         help="Seconds to get a connection to a node")
+    options.add_argument('--read-timeout', type=float, default=10,
+                         help="Seconds to wait for data from a node")
+    for operation, method in (("status", "GET"), ("create", "POST"), ("delete", "DELETE")):
+        options.add_argument(f'--{operation}-timeout', type=float, default=30, dest=f"timeout_{method}",
+                             help=f"Total seconds of each {operation} request ({method})")
+    options.add_argument('--hedge-percentile', type=float,
+                         help="Send a second status request when the first one is slower than this latency percentile")
+    options.add_argument('--shards', type=int, default=1,
+                         help="Worker processes the nodes are split across, each one with its own loop and connections")
+    options.add_argument('--pipeline', action='store_true',
+                         help="Do not wait for the status of every node, run the action on each node as soon as it is ready")
+    options.add_argument('--waves', type=parse_waves,
+                         help="Change the nodes of each group in waves, e.g. 1,1%%,10%%,100%%: each wave is the total of "
+                              "nodes or the percentage of them changed once it is done, a failure stops the next ones")
+    options.add_argument('--fail-fast', action='store_true',
+                         help="Cancel the requests in flight of a group as soon as one of its nodes fails")
+    options.add_argument('--log-level', type=str, default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                         help="Level of the run log")
+    options.add_argument('--log-file', type=str, default="/tmp/run.log",
+                         help="File of the run log, - for stderr")
+    options.add_argument('--events', type=str,
+                         help="File to write a JSON line for each node operation, - for stderr")
+    options.add_argument('--metrics-json', type=str,
+                         help="File to write the metrics of the run as JSON")
+    options.add_argument('--metrics-prom', type=str,
+                         help="File to write the metrics of the run in Prometheus text format")
+    options.add_argument('--state', type=str,
+                         help="State file with the groups known on each node, it is updated after each run")
+    options.add_argument('--max-state-age', type=float,
+                         help="Seconds after which a recorded node state is stale and has to be checked again")
+    options.add_argument('--journal', type=str,
+                         help="Write-ahead journal of every change, to resume the run if the process dies")
+    options.add_argument('--scoreboard', type=str,
+                         help="File keeping the latency and error rate of each node, the slowest ones are run first")
+    options.add_argument('--status-cache', type=str,
+                         help="File caching the status of each node between runs, recent ones are not requested again")
+    options.add_argument('--status-cache-ttl', type=float, default=60,
+                         help="Seconds a cached node status is used")
+    options.add_argument('--status-cache-size', type=int, default=100000,
+                         help="Max cached node statuses, the least recently used ones are dropped")
+
     parser = argparse.ArgumentParser(description='Cluster API: For creating groups and beyond :D')
-    parser.add_argument('action', type=str, nargs='?',  choices=['create_group', 'delete_group'],
-                        help='Action to perform: create_group or delete_group')
-    parser.add_argument('group_name', type=str, nargs='?',
-                        help='Group name')
-    parser.add_argument('node_file', nargs='?', type=argparse.FileType('r'),
-                        help="Json file with a list of string (nodes urls)")
+    commands = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for action in Coroutine.actions:
+        add_target_arguments(commands.add_parser(action, parents=[options], help=f"Run {action} checking every node"))
+    for command, help in (("plan", "Show the changes needed according to the state file"),
+                          ("apply", "Run the action checking only the nodes with an unknown or stale state")):
+        command_parser = commands.add_parser(command, parents=[options], help=help)
+        command_parser.add_argument('action', type=str, choices=list(Coroutine.actions),
+                                    help='Action to perform: create_group or delete_group')
+        add_target_arguments(command_parser)
+    resume_parser = commands.add_parser('resume', parents=[options],
+                                        help="Finish or roll back the run interrupted in the --journal file")
+    resume_parser.add_argument('--rollback', action='store_true',
+                               help="Roll back every group, by default only the ones that failed or were rolling back")
+    audit_parser = commands.add_parser('audit', parents=[options],
+                                       help="Check the groups on every node, report the drifted ones and repair them")
+    add_target_arguments(audit_parser)
+    audit_parser.add_argument('--expect', type=str, default="majority", choices=["present", "absent", "majority"],
+                              help="Expected state of the groups, by default the one of most nodes of each group")
+    audit_parser.add_argument('--repair', action='store_true',
+                              help="Create or delete the group on the drifted nodes only")
+    audit_parser.add_argument('--report', type=str, default="-",
+                              help="File to write a JSON line for each drifted node and a summary per group, - for stdout")
+    daemon_parser = commands.add_parser('daemon', parents=[options],
+                                        help="Serve jobs over HTTP, batching them on warm connections")
+    daemon_parser.add_argument('--host', type=str, default="127.0.0.1")
+    daemon_parser.add_argument('--port', type=int, default=8080)
+    daemon_parser.add_argument('--unix', type=str, help="Unix socket to listen on instead of host and port")
+    daemon_parser.add_argument('--batch-window', type=float, default=0.05,
+                               help="Seconds jobs are gathered before running them as one batch")
     args = parser.parse_args()
 
+    action = args.command if args.command in Coroutine.actions else getattr(args, "action", None)
+    if args.command in ("plan", "apply") and not args.state:
+        parser.error(f"{args.command} needs a --state file")
+    if args.command == "resume" and not args.journal:
+        parser.error("resume needs a --journal file")
+    if args.command == "audit" and (args.state or args.shards > 1 or args.waves or args.journal):
+        sys.exit("audit can not be used with --state, --shards, --waves or --journal")
+
+    state = None
+    if args.state:
+        try:
+            state = ClusterState.load(args.state, max_age=args.max_state_age)
+        except ValueError as e:
+            sys.exit(str(e))
+
+    status_cache = None
+    if args.status_cache:
+        try:
+            status_cache = StatusCache.load(args.status_cache, ttl=args.status_cache_ttl, max_size=args.status_cache_size)
+        except ValueError as e:
+            sys.exit(str(e))
+
+    scoreboard = None
+    if args.scoreboard:
+        try:
+            scoreboard = Scoreboard.load(args.scoreboard)
+        except ValueError as e:
+            sys.exit(str(e))
+
+    transport = None
+    if args.http2:
+        from transport import Http2Transport, TransportError
+        try:
+            transport = Http2Transport(limit=args.concurrency, keepalive_timeout=args.keepalive)
+        except TransportError as e:
+            sys.exit(str(e))
+
+    metrics = Metrics() if args.metrics_json or args.metrics_prom else None
+    retry_policy = RetryPolicy(backoff=args.backoff, max_backoff=args.max_backoff, budget=args.retry_budget)
+    session_options = dict(
+        limit=args.concurrency, limit_per_host=args.limit_per_host, keepalive_timeout=args.keepalive, ttl_dns_cache=args.dns_ttl,
+        retry_policy=retry_policy, breaker_threshold=args.breaker_threshold, breaker_cooldown=args.breaker_cooldown,
+        hedge_percentile=args.hedge_percentile, origin_limit=args.origin_concurrency, transport=transport,
+        timeouts={method: aiohttp.ClientTimeout(total=getattr(args, f"timeout_{method}"), connect=args.connect_timeout,
+                                                sock_read=args.read_timeout)
+                  for method in ("GET", "POST", "DELETE")},
+    )
+    session = NodeSession(metrics=metrics, status_cache=status_cache, scoreboard=scoreboard, **session_options)
+
+    def open_journal():
+        # Opened once every check passed, a rejected command leaves the journal of the last run as it was
+        from journal import Journal, JournalError, load
+        if args.command != "resume":
+            try:
+                ended = load(args.journal)[3]
+            except (OSError, JournalError):
+                ended = True
+            if not ended:
+                sys.exit(f"The journal {args.journal} holds an interrupted run, finish it with resume first")
+        # A new run starts a new journal, resume carries on with the same one
+        session.journal = Journal(args.journal, append=args.command == "resume")
+
+    def save_outputs():
+        if scoreboard is not None:
+            scoreboard.save()
+        if session.journal is not None:
+            asyncio.get_event_loop().run_until_complete(session.journal.close())
+        if status_cache is not None:
+            logger.info(f"Status cache: {status_cache.hits} hits, {status_cache.misses} misses")
+            status_cache.save()
+        if args.metrics_json:
+            with open(args.metrics_json, "w") as f:
+                f.write(metrics.to_json())
+        if args.metrics_prom:
+            with open(args.metrics_prom, "w") as f:
+                f.write(metrics.to_prometheus())
+
+    if args.command == "daemon":
+        if state is not None or args.shards > 1 or args.waves or args.journal:
+            sys.exit("The daemon can not be used with --state, --shards, --waves or --journal")
+        from aiohttp import web
+        from daemon import Daemon
+        daemon = Daemon(session, concurrency=args.concurrency, batch_window=args.batch_window, pipeline=args.pipeline,
+                        fail_fast=args.fail_fast)
+        logs = setup_logging(args.log_level, args.log_file, args.events)
+        try:
+            web.run_app(daemon.app(), print=None,
+                        **({"path": args.unix} if args.unix else {"host": args.host, "port": args.port}))
+        finally:
+            save_outputs()
+            logs.stop()
+        sys.exit()
+
+    if args.command == "resume":
+        from journal import JournalError, ResumedCoroutine
+        try:
+            c = ResumedCoroutine(args.journal, session, rollback=args.rollback, concurrency=args.concurrency)
+        except (OSError, JournalError) as e:
+            sys.exit(f"Journal can not be readed: {e}")
+        open_journal()
+        logs = setup_logging(args.log_level, args.log_file, args.events)
+        try:
+            c.run()
+        finally:
+            asyncio.get_event_loop().run_until_complete(session.close())
+            save_outputs()
+            logs.stop()
+        sys.exit()
+
+    # Nodes are streamed from the file, the run drops the duplicates, errors further in the file fail the run
     try:
-        nodes = json.loads(args.node_file.read())
-    except json.decoder.JSONDecodeError:
-        sys.exit("File can not be readed")
+        nodes = read_nodes(args.node_file)
+    except InventoryError as e:
+        sys.exit(str(e))
 
-    if not isinstance(nodes, list):
-        sys.exit("Root element must be a list")
+    if args.group_name.startswith("@"):
+        try:
+            with open(args.group_name[1:]) as f:
+                groups = [line.strip() for line in f if line.strip()]
+        except OSError:
+            sys.exit("Group file can not be readed")
+    else:
+        groups = [group.strip() for group in args.group_name.split(",") if group.strip()]
 
-    if any([not isinstance(node, str) for node in nodes]):
-        sys.exit("Nodes must be a string")
+    if not groups:
+        sys.exit("At least one group is needed")
 
-    c = Coroutine(args.action, set(nodes), args.group_name)
-    c.run()
+    if args.command == "audit":
+        from audit import AuditCoroutine
+        # Line buffered, every drifted node shows up as soon as it is found
+        if args.report == "-":
+            sys.stdout.reconfigure(line_buffering=True)
+            report = sys.stdout
+        else:
+            report = open(args.report, "w", buffering=1)
+        c = AuditCoroutine(nodes, groups, report, expect=args.expect, repair=args.repair, session=session,
+                           concurrency=args.concurrency)
+        logs = setup_logging(args.log_level, args.log_file, args.events)
+        try:
+            c.run()
+        finally:
+            asyncio.get_event_loop().run_until_complete(session.close())
+            save_outputs()
+            logs.stop()
+            if report is not sys.stdout:
+                report.close()
+        # Like diff, 1 when some node is not as expected
+        sys.exit(0 if c.status == CoroutineState.DONE else 1)
+
+    if args.waves and args.pipeline:
+        parser.error("--waves needs the status of every node, it can not be used with --pipeline")
+    if args.shards > 1:
+        if state is not None:
+            sys.exit("A state file can not be used with shards")
+        if args.waves:
+            sys.exit("Waves can not be used with shards")
+        if status_cache is not None:
+            sys.exit("A status cache can not be used with shards")
+        if args.journal:
+            sys.exit("A journal can not be used with shards")
+        if scoreboard is not None:
+            sys.exit("A scoreboard can not be used with shards")
+        from shard import ShardedCoroutine
+        # Shards need the whole inventory to split it
+        try:
+            nodes = list(nodes)
+        except InventoryError as e:
+            sys.exit(str(e))
+        c = ShardedCoroutine(action, nodes, groups, shards=args.shards, session_options=session_options,
+                             log_options={"level": args.log_level, "destination": args.log_file,
+                                          "events_destination": args.events},
+                             session=session, concurrency=args.concurrency, pipeline=args.pipeline, fail_fast=args.fail_fast)
+    else:
+        c = Coroutine(action, nodes, groups, session=session, concurrency=args.concurrency,
+                      state=state, refresh=args.command != "apply", pipeline=args.pipeline,
+                      fail_fast=args.fail_fast, waves=args.waves)
+
+    if args.command == "plan":
+        plan = c.plan()
+        sign = "+" if c.tasks and c.tasks[0].present_when_done else "-"
+        for task in plan["change"]:
+            print(f"{sign} {task.group} {task.node}")
+        for task in plan["unknown"]:
+            print(f"? {task.group} {task.node}")
+        print(f"Plan: {len(plan['change'])} to change, {len(plan['unknown'])} to check, {len(plan['unchanged'])} unchanged.")
+        sys.exit()
+
+    if args.journal:
+        open_journal()
+    logs = setup_logging(args.log_level, args.log_file, args.events)
+    try:
+        c.run()
+    finally:
+        asyncio.get_event_loop().run_until_complete(session.close())
+        save_outputs()
+        logs.stop()
@@ -0,0 +1,144 @@
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Histogram():
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for le, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield le, total
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {("+Inf" if le == float("inf") else str(le)): count for le, count in self.cumulative()},
+        }
+
+
+class Metrics():
+
+    def __init__(self, resolution=0.1):
+        self.started_at = time.monotonic()
+        # phase -> seconds
+        self.phases = defaultdict(float)
+        # (endpoint, status) -> Histogram
+        self.requests = defaultdict(Histogram)
+        # operation -> count
+        self.attempts = defaultdict(int)
+        self.retries = defaultdict(int)
+        # Max requests in flight in each window of `resolution` seconds
+        self.resolution = resolution
+        self.in_flight = 0
+        self.in_flight_max = 0
+        self.in_flight_windows = {}
+
+    @contextmanager
+    def phase(self, name):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.monotonic() - started_at
+
+    def request_started(self):
+        self.in_flight += 1
+        self.in_flight_max = max(self.in_flight_max, self.in_flight)
+        window = int((time.monotonic() - self.started_at) / self.resolution)
+        self.in_flight_windows[window] = max(self.in_flight_windows.get(window, 0), self.in_flight)
+
+    def request_finished(self, endpoint, status, latency):
+        self.in_flight -= 1
+        self.requests[(endpoint, str(status) if status is not None else "error")].observe(latency)
+
+    def attempt(self, operation, attempt_number):
+        self.attempts[operation] += 1
+        if attempt_number > 1:
+            self.retries[operation] += 1
+
+    def merge(self, other):
+        # Adds the requests of another process, like a shard. Its windows are aligned on the monotonic clock, shared by
+        # the processes of a host, and the max of each one is added, so the in flight counts are an upper bound
+        for key, histogram in other.requests.items():
+            self.requests[key].merge(histogram)
+        for operation, count in other.attempts.items():
+            self.attempts[operation] += count
+        for operation, count in other.retries.items():
+            self.retries[operation] += count
+        offset = round((other.started_at - self.started_at) / self.resolution)
+        for window, count in other.in_flight_windows.items():
+            window += offset
+            self.in_flight_windows[window] = self.in_flight_windows.get(window, 0) + count
+        self.in_flight_max = max([self.in_flight_max, other.in_flight_max, *self.in_flight_windows.values()])
+
+    def to_dict(self):
+        return {
+            "phases": dict(self.phases),
+            "requests": [
+                {"endpoint": endpoint, "status": status, **histogram.to_dict()}
+                for (endpoint, status), histogram in sorted(self.requests.items())
+            ],
+            "attempts": dict(self.attempts),
+            "retries": dict(self.retries),
+            "in_flight": {
+                "max": self.in_flight_max,
+                "resolution": self.resolution,
+                "windows": [[window * self.resolution, count] for window, count in sorted(self.in_flight_windows.items())],
+            },
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP cluster_phase_seconds Wall time of each phase of the run",
+            "# TYPE cluster_phase_seconds gauge",
+        ]
+        lines += [f'cluster_phase_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in self.phases.items()]
+
+        lines += [
+            "# HELP cluster_request_duration_seconds Latency of the requests to the nodes",
+            "# TYPE cluster_request_duration_seconds histogram",
+        ]
+        for (endpoint, status), histogram in sorted(self.requests.items()):
+            labels = f'endpoint="{endpoint}",status="{status}"'
+            for le, count in histogram.cumulative():
+                lines.append(f'cluster_request_duration_seconds_bucket{{{labels},le="{"+Inf" if le == float("inf") else le}"}} {count}')
+            lines.append(f"cluster_request_duration_seconds_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"cluster_request_duration_seconds_count{{{labels}}} {histogram.count}")
+
+        for name, help, values in (("attempts", "Attempts of each node operation", self.attempts),
+                                   ("retries", "Retries of each node operation", self.retries)):
+            lines += [f"# HELP cluster_{name}_total {help}", f"# TYPE cluster_{name}_total counter"]
+            lines += [f'cluster_{name}_total{{operation="{operation}"}} {count}' for operation, count in values.items()]
+
+        lines += [
+            "# HELP cluster_in_flight_max Max requests in flight at the same time",
+            "# TYPE cluster_in_flight_max gauge",
+            f"cluster_in_flight_max {self.in_flight_max}",
+        ]
+        return "\n".join(lines) + "\n"
@@ -1,15 +1,87 @@
 from abc import ABC, abstractclassmethod
+from array import array
+import asyncio
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
 from enum import Enum
 import logging
+import random
 
 import aiohttp
 from tenacity import retry, stop_after_attempt, retry_if_exception_type
 
+from inventory import NodeSet
+from logs import events
+from transport import AiohttpTransport, TransportError
+
 logger = logging.getLogger(__name__)
 
 
 class NodeAction(ABC):
 
+    # A flyweight over a row of a NodeTable, it keeps no state of its own
+    __slots__ = ("table", "row", "session")
+
+    def __init__(self, node, session=None, group=None):
+        # A node on its own gets a table of one row, `at` is used for the rows of a shared table
+        self.table = NodeTable([group])
+        self.row = self.table.add(self.table.add_node(node), 0)
+        self.session = session
+
+    @classmethod
+    def at(cls, table, row, session=None):
+        action = cls.__new__(cls)
+        action.table = table
+        action.row = row
+        action.session = session
+        return action
+
+    @property
+    def node(self):
+        return self.table.node(self.row)
+
+    @property
+    def group(self):
+        return self.table.group(self.row)
+
+    @property
+    def status(self):
+        return self.table.status(self.row)
+
+    @status.setter
+    def status(self, status):
+        self.table.set_status(self.row, status)
+
+    def _cached_status(self, group_name):
+        # A node checked or changed recently takes its status from the cache of the session, without any request
+        cache = self.session.status_cache if self.session is not None else None
+        present = cache.get(self.node, group_name) if cache is not None else None
+        if present is None:
+            return False
+        self.status = NodeActionState.NOT_NEEDED if present == self.present_when_done else NodeActionState.READY
+        return True
+
+    async def _journal_start(self, operation, group_name):
+        # The intent is on disk before the request is sent
+        journal = self.session.journal if self.session is not None else None
+        if journal is not None:
+            await journal.commit({"event": "start", "op": operation, "node": self.node, "group": group_name})
+
+    def _journal_end(self, operation, group_name, event):
+        journal = self.session.journal if self.session is not None else None
+        if journal is not None:
+            journal.append({"event": event, "op": operation, "node": self.node, "group": group_name})
+
+    def _remember(self, group_name, present):
+        # None forgets the node: a change is in flight or failed, so its result is not known
+        cache = self.session.status_cache if self.session is not None else None
+        if cache is None:
+            return
+        if present is None:
+            cache.invalidate(self.node, group_name)
+        else:
+            cache.set(self.node, group_name, present)
+
     @abstractclassmethod
     async def get_current_status(self, *args, **kwargs):
         pass
@@ -29,6 +101,97 @@ class NodeActionState(Enum):
     DONE = 3
     ROLLED_BACK = 4
     ERROR = 5
+    # The action was cancelled in flight, it may or may not have been applied
+    UNKNOWN = 6
+
+
+def node_origin(node):
+    # scheme://host:port of a node url, the logical nodes behind it share its connections
+    scheme, separator, rest = node.partition("://")
+    return f"{scheme}{separator}{rest.split('/', 1)[0]}" if separator else node.split("/", 1)[0]
+
+
+class NodeTable():
+
+    # Every (group, node) pair of a run is a row. Node urls are stored once and rows point to them by id, a node added
+    # twice is dropped. Statuses take a byte per row, 0 while there is none
+    names = ["PENDING"] + [state.name for state in NodeActionState]
+
+    def __init__(self, groups=()):
+        self.groups = list(groups)
+        self.nodes = []
+        self._node_set = NodeSet(self.nodes)
+        # node id -> origin id
+        self.origins = []
+        self.node_origins = array("I")
+        self._origin_ids = {}
+        # row -> node id, row -> group index, row -> NodeActionState value
+        self.node_ids = array("I")
+        self.group_ids = array("H")
+        self.statuses = bytearray()
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def add_node(self, node):
+        # The id of the node, None when it is already in the table
+        if not self._node_set.add(node):
+            return None
+        origin = node_origin(node)
+        origin_id = self._origin_ids.get(origin)
+        if origin_id is None:
+            origin_id = self._origin_ids[origin] = len(self.origins)
+            self.origins.append(origin)
+        self.node_origins.append(origin_id)
+        return len(self.nodes) - 1
+
+    def add(self, node_id, group_id):
+        self.node_ids.append(node_id)
+        self.group_ids.append(group_id)
+        self.statuses.append(0)
+        return len(self.statuses) - 1
+
+    def node(self, row):
+        return self.nodes[self.node_ids[row]]
+
+    def group(self, row):
+        return self.groups[self.group_ids[row]]
+
+    def status(self, row):
+        value = self.statuses[row]
+        return NodeActionState(value) if value else None
+
+    def set_status(self, row, status):
+        self.statuses[row] = status.value if status else 0
+
+    def select(self, states, groups=None, rows=None):
+        # Rows in one of `states`, of one of `groups` and among `rows` when they are given
+        values = {state.value if state else 0 for state in states}
+        group_ids = None if groups is None else {i for i, group in enumerate(self.groups) if group in groups}
+        if rows is None and len(values) == 1:
+            rows = self._find(next(iter(values)))
+        elif rows is None:
+            rows = range(len(self.statuses))
+        statuses, all_group_ids = self.statuses, self.group_ids
+        return array("I", (row for row in rows if statuses[row] in values
+                           and (group_ids is None or all_group_ids[row] in group_ids)))
+
+    def _find(self, value):
+        # bytearray.find scans in C, rows in other states are never visited from Python
+        statuses, needle = self.statuses, bytes([value])
+        row = statuses.find(needle)
+        while row != -1:
+            yield row
+            row = statuses.find(needle, row + 1)
+
+    def groups_of(self, rows):
+        return {self.groups[i] for i in {self.group_ids[row] for row in rows}}
+
+    def nodes_by_state(self):
+        nodes = [defaultdict(list) for _ in self.groups]
+        for node_id, group_id, value in zip(self.node_ids, self.group_ids, self.statuses):
+            nodes[group_id][self.names[value]].append(self.nodes[node_id])
+        return {group: dict(i) for group, i in zip(self.groups, nodes)}
 
 
 class NodeGeneralError(Exception):
@@ -49,123 +212,405 @@ class NodeGroupNotFound(NodeGeneralError):
     pass
 
 
+class NodeUnavailable(NodeGeneralError):
+    # Raised without any request when the circuit of the node is open, it is not retried
+    pass
+
+
+class RetryPolicy():
+
+    def __init__(self, backoff=0.1, max_backoff=5, budget=0.2, min_retries=10, seed=None):
+        # Exponential backoff with full jitter: a random wait in [0, min(max_backoff, backoff * 2^n)]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # A seed makes the jitter reproducible, e.g. in simulations
+        self.random = random.Random(seed)
+        # Retries allowed as a ratio of the requests done, None means no limit
+        self.budget = budget
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+
+    def wait(self, attempt):
+        return self.random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def can_retry(self):
+        return self.budget is None or self.retries < self.min_retries + self.budget * self.requests
+
+    def acquire_retry(self):
+        if not self.can_retry():
+            return False
+        self.retries += 1
+        return True
+
+
+class CircuitBreaker():
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self, now):
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at >= self.cooldown:
+            # Half open: a single request goes through, the next cooldown starts now
+            self.opened_at = now
+            return True
+        return False
+
+    def record(self, success, now):
+        if success:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = now
+
+
+_default_policy = RetryPolicy(budget=None)
+
+
+def _retry_policy(retry_state):
+    session = retry_state.args[0].session
+    return session.retry_policy if session is not None else _default_policy
+
+
+def _wait_backoff(retry_state):
+    return _retry_policy(retry_state).wait(retry_state.attempt_number)
+
+
+def _retry_if_budget(retry_state):
+    # tenacity asks before checking the stop, so the budget is only taken once the retry is certain, see _take_budget
+    return _retry_policy(retry_state).can_retry()
+
+
+def _take_budget(retry_state):
+    _retry_policy(retry_state).acquire_retry()
+
+
+def _count_attempt(retry_state):
+    session = retry_state.args[0].session
+    if session is not None and session.metrics is not None:
+        session.metrics.attempt(retry_state.fn.__qualname__, retry_state.attempt_number)
+
+
+# Shared by every NodeAction method, tenacity builds a different Retrying object for each one
+node_retry = retry(stop=stop_after_attempt(3), wait=_wait_backoff, before=_count_attempt, before_sleep=_take_budget,
+                   retry=retry_if_exception_type(NodeError) & _retry_if_budget)
+
+
 class CreateGroup(NodeAction):
 
-    def __init__(self, node):
-        self.node = node
-        self.status = None
+    __slots__ = ()
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    # Whether the group exists on the node once the action is done
+    present_when_done = True
+
+    @node_retry
     async def forward(self, group_name):
+        self._remember(group_name, None)
+        await self._journal_start("forward", group_name)
         try:
-            response = await NodeClient.create_group(self.node, group_name)
-        except NodeError as e:
+            response = await NodeClient.create_group(self.node, group_name, session=self.session)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._journal_end("forward", group_name, "error")
             raise e
         else:
             self.status = NodeActionState.DONE
+            self._remember(group_name, self.present_when_done)
+            self._journal_end("forward", group_name, "done")
             return response
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    @node_retry
     async def backward(self, group_name):
+        self._remember(group_name, None)
+        await self._journal_start("backward", group_name)
         try:
-            response = await NodeClient.delete_group(self.node, group_name)
-        except NodeError as e:
+            response = await NodeClient.delete_group(self.node, group_name, session=self.session)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._journal_end("backward", group_name, "error")
             raise e
         else:
             self.status = NodeActionState.ROLLED_BACK
+            self._remember(group_name, not self.present_when_done)
+            self._journal_end("backward", group_name, "done")
             return response
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    @node_retry
     async def get_current_status(self, group_name):
+        if self._cached_status(group_name):
+            return
         try:
-            response = await NodeClient.get_group(self.node, group_name)
+            response = await NodeClient.get_group(self.node, group_name, session=self.session)
         except NodeGroupNotFound:
             self.status = NodeActionState.READY
-        except NodeError as e:
+            self._remember(group_name, False)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._remember(group_name, None)
             raise e
         else:
             self.status = NodeActionState.NOT_NEEDED
+            self._remember(group_name, True)
             return response
 
 
 class DeleteGroup(NodeAction):
 
-    def __init__(self, node):
-        self.node = node
-        self.status = None
+    __slots__ = ()
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    present_when_done = False
+
+    @node_retry
     async def forward(self, group_name):
+        self._remember(group_name, None)
+        await self._journal_start("forward", group_name)
         try:
-            response = await NodeClient.delete_group(self.node, group_name)
-        except NodeError as e:
+            response = await NodeClient.delete_group(self.node, group_name, session=self.session)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._journal_end("forward", group_name, "error")
             raise e
         else:
             self.status = NodeActionState.DONE
+            self._remember(group_name, self.present_when_done)
+            self._journal_end("forward", group_name, "done")
             return response
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    @node_retry
     async def backward(self, group_name):
+        self._remember(group_name, None)
+        await self._journal_start("backward", group_name)
         try:
-            response = await NodeClient.create_group(self.node, group_name)
-        except NodeError as e:
+            response = await NodeClient.create_group(self.node, group_name, session=self.session)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._journal_end("backward", group_name, "error")
             raise e
         else:
             self.status = NodeActionState.ROLLED_BACK
+            self._remember(group_name, not self.present_when_done)
+            self._journal_end("backward", group_name, "done")
             return response
 
-    @retry(stop=stop_after_attempt(3), retry=retry_if_exception_type(NodeError))
+    @node_retry
     async def get_current_status(self, group_name):
+        if self._cached_status(group_name):
+            return
         try:
-            response = await NodeClient.get_group(self.node, group_name)
+            response = await NodeClient.get_group(self.node, group_name, session=self.session)
         except NodeGroupNotFound:
             self.status = NodeActionState.NOT_NEEDED
-        except NodeError as e:
+            self._remember(group_name, False)
+        except NodeGeneralError as e:
             self.status = NodeActionState.ERROR
+            self._remember(group_name, None)
             raise e
         else:
             self.status = NodeActionState.READY
+            self._remember(group_name, True)
             return response
 
 
+class NodeSession():
+
+    default_timeout = aiohttp.ClientTimeout(total=30, connect=5, sock_read=10)
+
+    def __init__(self, limit=100, limit_per_host=0, keepalive_timeout=15, ttl_dns_cache=300, retry_policy=None,
+                 breaker_threshold=5, breaker_cooldown=30, timeouts=None, hedge_percentile=None, hedge_min_samples=20,
+                 trace_configs=None, metrics=None, status_cache=None, journal=None, scoreboard=None, origin_limit=None,
+                 transport=None):
+        # Sends the requests, see transport.Transport. The pool options are the ones of the default aiohttp transport
+        self.transport = transport if transport is not None else AiohttpTransport(
+            limit=limit, limit_per_host=limit_per_host, keepalive_timeout=keepalive_timeout, ttl_dns_cache=ttl_dns_cache,
+            trace_configs=trace_configs)
+        self.metrics = metrics
+        # Shared by every action using this session, see state.StatusCache
+        self.status_cache = status_cache
+        # Write-ahead journal of the changes of a run, see journal.Journal
+        self.journal = journal
+        # Latency and error rate of each node, see scoreboard.Scoreboard
+        self.scoreboard = scoreboard
+        # Max requests in flight to each origin, on top of the limit of the whole pool
+        self.origin_limit = origin_limit
+        self._origin_slots = defaultdict(lambda: asyncio.Semaphore(self.origin_limit))
+        # Shared by every phase and action using this session
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.breakers = defaultdict(lambda: CircuitBreaker(breaker_threshold, breaker_cooldown))
+        # HTTP method -> aiohttp.ClientTimeout
+        self.timeouts = timeouts or {}
+        # Hedged requests: when a request is slower than this percentile of the latest ones, a second one is sent
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = defaultdict(lambda: deque(maxlen=1000))
+        self._samples = defaultdict(int)
+        self._hedge_delays = {}
+
+    @property
+    def session(self):
+        # aiohttp.ClientSession of the default transport
+        return self.transport.session
+
+    async def request(self, node, method, path, hedge=False, endpoint=None, **kwargs):
+        endpoint = endpoint or method
+        delay = self._hedge_delay(method) if hedge else None
+        if delay is None:
+            return await self._send(node, method, path, endpoint, **kwargs)
+
+        first = asyncio.ensure_future(self._send(node, method, path, endpoint, **kwargs))
+        pending = {first}
+        error = None
+        # Whatever is still in flight is cancelled on the way out, also when the caller is cancelled while waiting
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            logger.debug("Hedging %s %s on %s after %.3fs", method, path, node, delay)
+            pending.add(asyncio.ensure_future(self._send(node, method, path, endpoint, **kwargs)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    if request.exception() is None:
+                        return request.result()
+                    error = error or request.exception()
+            raise error
+        finally:
+            for request in pending:
+                request.cancel()
+
+    def _hedge_delay(self, method):
+        latencies = self.latencies[method]
+        if self.hedge_percentile is None or len(latencies) < self.hedge_min_samples:
+            return None
+        # Sorting on every request is too expensive, the percentile is refreshed every 50 samples
+        computed_at, delay = self._hedge_delays.get(method, (None, None))
+        if computed_at is None or self._samples[method] - computed_at >= 50:
+            ordered = sorted(latencies)
+            delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+            self._hedge_delays[method] = (self._samples[method], delay)
+        return delay
+
+    async def _send(self, node, method, path, endpoint, **kwargs):
+        if not self.origin_limit:
+            return await self._send_now(node, method, path, endpoint, **kwargs)
+        async with self._origin_slots[node_origin(node)]:
+            return await self._send_now(node, method, path, endpoint, **kwargs)
+
+    async def _send_now(self, node, method, path, endpoint, **kwargs):
+        loop = asyncio.get_running_loop()
+        breaker = self.breakers[node]
+        if not breaker.allow(loop.time()):
+            raise NodeUnavailable(node, None, "circuit open, the node keeps failing")
+
+        self.retry_policy.requests += 1
+        kwargs.setdefault("timeout", self.timeouts.get(method, self.default_timeout))
+        if self.metrics is not None:
+            self.metrics.request_started()
+        started_at = loop.time()
+        status = None
+        try:
+            response, text = await self.transport.request(method, f"{node}{path}", **kwargs)
+            status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError, TransportError) as e:
+            breaker.record(False, loop.time())
+            if self.scoreboard is not None:
+                self.scoreboard.record(node, loop.time() - started_at, False)
+            raise NodeError(node, None, str(e) or e.__class__.__name__)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.request_finished(endpoint, status, loop.time() - started_at)
+        self.latencies[method].append(loop.time() - started_at)
+        self._samples[method] += 1
+        breaker.record(response.status < 500, loop.time())
+        if self.scoreboard is not None:
+            self.scoreboard.record(node, loop.time() - started_at, response.status < 500)
+        return response, text
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+@asynccontextmanager
+async def _session_scope(session):
+    if session is not None:
+        yield session
+    else:
+        async with NodeSession() as session:
+            yield session
+
+
+@contextmanager
+def _operation_event(operation, node, group_name):
+    if not events.isEnabledFor(logging.INFO):
+        yield {}
+        return
+    event = {"op": operation, "node": node, "group": group_name, "code": None}
+    # The loop clock, it is the virtual one in simulations
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    try:
+        yield event
+    except Exception as e:
+        event["error"] = e.__class__.__name__
+        raise
+    finally:
+        event["elapsed"] = round(loop.time() - started_at, 6)
+        events.info(operation, extra={"event": event})
+
+
 class NodeClient():
 
     @staticmethod
-    async def create_group(node, group_name):
-        logger.debug(f"Creating group {group_name} on {node}")
-        async with aiohttp.ClientSession() as session:
-            response = await session.post(f"{node}/v1/group", json={"groupId": group_name})
-            text = await response.text()
-        if not response.status == 201:
-            raise NodeError(node, response.status, text)
-        logger.debug(f"Finishing group creation {group_name} on {node}")
+    async def create_group(node, group_name, session=None):
+        logger.debug("Creating group %s on %s", group_name, node)
+        with _operation_event("create_group", node, group_name) as event:
+            async with _session_scope(session) as session:
+                response, text = await session.request(node, "POST", "/v1/group", endpoint="create_group", json={"groupId": group_name})
+            event["code"] = response.status
+            if not response.status == 201:
+                raise NodeError(node, response.status, text)
+        logger.debug("Finishing group creation %s on %s", group_name, node)
         return response
 
     @staticmethod
-    async def delete_group(node, group_name):
-        logger.debug(f"Deleting group {group_name} on {node}")
-        async with aiohttp.ClientSession() as session:
-            response = await session.delete(f"{node}/v1/group", json={"groupId": group_name})
-            text = await response.text()
-        if not response.status == 200:
-            raise NodeError(node, response.status, text)
-        logger.debug(f"Finishing group deletion {group_name} on {node}")
+    async def delete_group(node, group_name, session=None):
+        logger.debug("Deleting group %s on %s", group_name, node)
+        with _operation_event("delete_group", node, group_name) as event:
+            async with _session_scope(session) as session:
+                response, text = await session.request(node, "DELETE", "/v1/group", endpoint="delete_group", json={"groupId": group_name})
+            event["code"] = response.status
+            if not response.status == 200:
+                raise NodeError(node, response.status, text)
+        logger.debug("Finishing group deletion %s on %s", group_name, node)
         return response
 
     @staticmethod
-    async def get_group(node, group_name):
-        logger.debug(f"Getting group {group_name} from {node}")
-        async with aiohttp.ClientSession() as session:
-            response = await session.get(f"{node}/v1/group/{group_name}")
-            text = await response.text()
-        if response.status == 404:
-            raise NodeGroupNotFound(node, response.status, text)
-        elif not response.status == 200:
-            raise NodeError(node, response.status, text)
-        logger.debug(f"Finishing getting group {group_name} from {node}")
+    async def get_group(node, group_name, session=None):
+        logger.debug("Getting group %s from %s", group_name, node)
+        with _operation_event("get_group", node, group_name) as event:
+            async with _session_scope(session) as session:
+                response, text = await session.request(node, "GET", f"/v1/group/{group_name}", hedge=True,
+                                                       endpoint="get_group")
+            event["code"] = response.status
+            if response.status == 404:
+                raise NodeGroupNotFound(node, response.status, text)
+            elif not response.status == 200:
+                raise NodeError(node, response.status, text)
+        logger.debug("Finishing getting group %s from %s", group_name, node)
         return response
@@ -0,0 +1,86 @@
+import os
+import struct
+import sys
+import time
+from array import array
+
+
+class Scoreboard():
+
+    # Health of every node seen so far: moving averages of its latency and error rate and the last time it answered.
+    # The file keeps each column as a block of doubles followed by the node urls, so it loads without parsing
+    magic = b"SCB1"
+    header = struct.Struct("<4sI")
+
+    def __init__(self, path=None, alpha=0.2):
+        self.path = path
+        # Weight of the latest request in the moving averages
+        self.alpha = alpha
+        self.index = {}
+        self.nodes = []
+        self.latency = array("d")
+        self.error_rate = array("d")
+        self.last_seen = array("d")
+
+    @classmethod
+    def load(cls, path, alpha=0.2):
+        scoreboard = cls(path, alpha=alpha)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return scoreboard
+        try:
+            magic, count = cls.header.unpack_from(data)
+        except struct.error:
+            magic = None
+        if magic != cls.magic or len(data) < cls.header.size + 24 * count:
+            raise ValueError(f"Unsupported scoreboard format in {path}")
+        offset = cls.header.size
+        for column in (scoreboard.latency, scoreboard.error_rate, scoreboard.last_seen):
+            column.frombytes(data[offset:offset + 8 * count])
+            if sys.byteorder == "big":
+                column.byteswap()
+            offset += 8 * count
+        scoreboard.nodes = data[offset:].decode().split("\n") if count else []
+        scoreboard.index = {node: i for i, node in enumerate(scoreboard.nodes)}
+        return scoreboard
+
+    def record(self, node, latency, success):
+        i = self.index.get(node)
+        if i is None:
+            i = self.index[node] = len(self.nodes)
+            self.nodes.append(node)
+            self.latency.append(latency)
+            self.error_rate.append(0.0 if success else 1.0)
+            self.last_seen.append(0.0)
+        else:
+            self.latency[i] += self.alpha * (latency - self.latency[i])
+            self.error_rate[i] += self.alpha * ((0.0 if success else 1.0) - self.error_rate[i])
+        if success:
+            self.last_seen[i] = time.time()
+
+    def scores(self, nodes):
+        # Expected seconds to get an answer from each node: its latency times the expected attempts.
+        # Nodes never seen get the average of the known ones
+        scores = [None] * len(nodes)
+        known = []
+        for j, node in enumerate(nodes):
+            i = self.index.get(node)
+            if i is not None:
+                scores[j] = self.latency[i] / (1 - min(self.error_rate[i], 0.9))
+                known.append(scores[j])
+        default = sum(known) / len(known) if known else 0.0
+        return [default if score is None else score for score in scores]
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.header.pack(self.magic, len(self.nodes)))
+            for column in (self.latency, self.error_rate, self.last_seen):
+                if sys.byteorder == "big":
+                    column = array("d", column)
+                    column.byteswap()
+                f.write(column.tobytes())
+            f.write("\n".join(self.nodes).encode())
+        os.replace(tmp_path, self.path)
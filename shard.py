@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import multiprocessing
+from collections import defaultdict
+
+from logs import setup_logging
+from coroutine import Coroutine
+from metrics import Metrics
+from node import NodeSession
+
+logger = logging.getLogger(__name__)
+
+
+class ShardError(Exception):
+    pass
+
+
+def _shard_worker(conn, action, nodes, groups, options, session_options, log_options, metrics=False):
+    logs = setup_logging(**log_options) if log_options else None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    session = NodeSession(metrics=Metrics() if metrics else None, **session_options)
+    coroutine = Coroutine(action, nodes, groups, session=session, **options)
+    phases = {
+        "status": coroutine._status_phase,
+        "forward": coroutine._forward_phase,
+        "pipeline": coroutine._pipeline_phase,
+        "rollback": coroutine._rollback_phase,
+    }
+    try:
+        while True:
+            command, args = conn.recv()
+            if command == "close":
+                break
+            try:
+                if command == "nodes":
+                    value = coroutine.nodes_by_state()
+                elif command == "metrics":
+                    value = session.metrics
+                else:
+                    value = loop.run_until_complete(phases[command](*args))
+            except Exception as e:
+                conn.send((False, f"{e.__class__.__name__}: {e}"))
+            else:
+                conn.send((True, value))
+    finally:
+        loop.run_until_complete(session.close())
+        loop.close()
+        if logs is not None:
+            logs.stop()
+        conn.close()
+
+
+class ShardedCoroutine(Coroutine):
+
+    # Every shard is a process with its own event loop and session, the coordinator runs each phase on all of them
+    # and only moves to the next one when every shard is done, so any failure rolls back every shard
+
+    def __init__(self, action, nodes, group, shards=2, session_options=None, log_options=None, session=None,
+                 concurrency=100, pipeline=False, fail_fast=False):
+        super().__init__(action, [], group, session=session, concurrency=concurrency, pipeline=pipeline, fail_fast=fail_fast)
+        # A node listed twice would end up in two shards
+        nodes = list(dict.fromkeys(nodes))
+        self.shards = [nodes[i::shards] for i in range(shards)]
+        self.options = {"concurrency": concurrency, "pipeline": pipeline, "fail_fast": fail_fast}
+        self.session_options = session_options or {"limit": concurrency or 0}
+        self.log_options = log_options
+        self._connections = []
+
+    async def run_async(self):
+        context = multiprocessing.get_context("spawn")
+        processes = []
+        for nodes in self.shards:
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_worker, daemon=True, args=(
+                child_conn, self.action, nodes, self.groups, self.options, self.session_options, self.log_options,
+                self.session.metrics is not None,
+            ))
+            process.start()
+            child_conn.close()
+            self._connections.append(conn)
+            processes.append(process)
+
+        try:
+            return await super().run_async()
+        finally:
+            # The requests are sent by the shards, the session of the coordinator only times the phases
+            if self.session.metrics is not None:
+                self._merge_metrics()
+            for conn in self._connections:
+                try:
+                    conn.send(("close", ()))
+                except OSError:
+                    pass
+            for process in processes:
+                await asyncio.get_running_loop().run_in_executor(None, process.join, 30)
+                if process.is_alive():
+                    process.terminate()
+            self._connections = []
+
+    def _merge_metrics(self):
+        for reply in [self._call(conn, "metrics", ()) for conn in self._connections]:
+            if isinstance(reply, ShardError):
+                logger.error(f"Unable to get the metrics of a shard: {reply}")
+                continue
+            self.session.metrics.merge(reply)
+
+    def nodes_by_state(self):
+        nodes = {group: defaultdict(list) for group in self.groups}
+        for reply in [self._call(conn, "nodes", ()) for conn in self._connections]:
+            if isinstance(reply, ShardError):
+                logger.error(f"Unable to get the nodes of a shard: {reply}")
+                continue
+            for group, states in reply.items():
+                for state, group_nodes in states.items():
+                    nodes[group][state].extend(group_nodes)
+        return {group: dict(i) for group, i in nodes.items()}
+
+    async def _status_phase(self):
+        failed = set()
+        for reply in await self._broadcast("status"):
+            failed |= set(self.groups) if isinstance(reply, ShardError) else reply
+        return failed
+
+    async def _forward_phase(self, failed):
+        ran, errors = set(), defaultdict(list)
+        for reply in await self._broadcast("forward", failed):
+            self._merge_forward(reply, ran, errors, set(self.groups) - failed)
+        return ran, errors
+
+    async def _pipeline_phase(self):
+        failed, ran, errors = set(), set(), defaultdict(list)
+        for reply in await self._broadcast("pipeline"):
+            if not isinstance(reply, ShardError):
+                failed |= reply[0]
+                reply = reply[1:]
+            self._merge_forward(reply, ran, errors, set(self.groups))
+        return failed, ran, errors
+
+    async def _rollback_phase(self, groups):
+        rolled_back, errors = set(), defaultdict(list)
+        for reply in await self._broadcast("rollback", groups):
+            self._merge_forward(reply, rolled_back, errors, groups)
+        return rolled_back, errors
+
+    @staticmethod
+    def _merge_forward(reply, ran, errors, groups):
+        if isinstance(reply, ShardError):
+            # Nothing is known about the nodes of a lost shard, any of them may have been changed
+            for group in groups:
+                ran.add(group)
+                errors[group].append(str(reply))
+            return
+        shard_ran, shard_errors = reply
+        ran |= shard_ran
+        for group, group_errors in shard_errors.items():
+            errors[group].extend(group_errors)
+
+    async def _broadcast(self, command, *args):
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(None, self._call, conn, command, args)
+                                      for conn in self._connections])
+
+    @staticmethod
+    def _call(conn, command, args):
+        try:
+            conn.send((command, args))
+            ok, value = conn.recv()
+        except (EOFError, OSError) as e:
+            return ShardError(f"Shard lost: {e!r}")
+        return value if ok else ShardError(value)
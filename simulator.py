@@ -0,0 +1,209 @@
+import asyncio
+import json
+import selectors
+import time
+from collections import Counter
+
+import aiohttp
+
+from app import FakeCluster, uniforms
+from coroutine import Coroutine, CoroutineState
+from node import NodeSession, RetryPolicy
+from transport import Transport, TransportError
+
+
+class VirtualSelector():
+
+    # Sockets and threads still wake the loop up, but when the loop would sleep until its next timer the clock jumps
+    # to it instead. Real I/O and executor jobs take no virtual time
+    def __init__(self, clock):
+        self.clock = clock
+        self._selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # Nothing scheduled, only another thread can wake the loop
+            return self._selector.select()
+        self.clock.advance(timeout)
+        return []
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+
+    # loop.time() is a virtual clock starting at 0, so sleeps, timeouts, backoffs and circuit breaker cooldowns all
+    # happen instantly and in the same order on every run
+    def __init__(self):
+        self._now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self._now
+
+    def advance(self, seconds):
+        self._now += seconds
+
+
+class SimulatedResponse():
+
+    def __init__(self, status, text):
+        self.status = status
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+    async def json(self):
+        return json.loads(self._text)
+
+
+class SimulatedTransport(Transport):
+
+    # Every url is answered by a FakeCluster in the same loop: its latency and failures are seeded per node.
+    # `down_nodes` is the ratio of nodes refusing every connection
+    def __init__(self, cluster, down_nodes=0, connect_latency=0.001):
+        self.cluster = cluster
+        self.down_nodes = down_nodes
+        self.connect_latency = connect_latency
+        self.refused = 0
+        self.timeouts = 0
+
+    def is_down(self, node):
+        return self.down_nodes > 0 and uniforms(self.cluster.seed, node, "down")[0] < self.down_nodes
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        node, _, name = url.rpartition("/v1/group")
+        if self.is_down(node):
+            await asyncio.sleep(self.connect_latency)
+            self.refused += 1
+            raise TransportError(f"Cannot connect to {node}: Connection refused")
+        total = timeout.total if timeout is not None else None
+        try:
+            if method == "GET":
+                status, body = await self.cluster.get(node, name.lstrip("/"), total)
+            elif method == "POST":
+                status, body = await self.cluster.create(node, kwargs["json"]["groupId"], total)
+            else:
+                status, body = await self.cluster.delete(node, kwargs["json"]["groupId"], total)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        text = json.dumps(body) if isinstance(body, dict) else body
+        return SimulatedResponse(status, text), text
+
+    async def close(self):
+        pass
+
+
+def preload(cluster, nodes, groups, present):
+    # Ratio of the nodes having each group before the run, so delete_group has something to delete
+    for node in nodes:
+        for group in groups:
+            if uniforms(cluster.seed, node, group, "present")[0] < present:
+                cluster.groups[node].add(group)
+
+
+async def run_simulation(action, nodes, groups, cluster, transport, concurrency=100, timeout=30, seed=0,
+                         **options):
+    loop = asyncio.get_running_loop()
+    before = {(node, group): group in cluster.groups[node] for node in nodes for group in groups}
+    session = NodeSession(
+        limit=concurrency or 0, transport=transport, retry_policy=RetryPolicy(seed=seed),
+        timeouts={method: aiohttp.ClientTimeout(total=timeout) for method in ("GET", "POST", "DELETE")},
+    )
+    coroutine = Coroutine(action, nodes, groups, session=session, concurrency=concurrency, **options)
+    started_at = loop.time()
+    result = await coroutine.run_async()
+    makespan = loop.time() - started_at
+
+    states = Counter()
+    for group_states in result.nodes.values():
+        for state, group_nodes in group_states.items():
+            states[state] += len(group_nodes)
+    # Groups where the run failed, their nodes should be as they were before it
+    failed = [group for group in groups if result.statuses[group] in (CoroutineState.ROLLED_BACK, CoroutineState.ERROR)]
+    requests = cluster.stats()["requests"]
+    return {
+        "action": action,
+        "nodes": len(nodes),
+        "groups": len(groups),
+        "status": result.status.name if result.status else None,
+        "makespan": makespan,
+        "requests": requests,
+        "amplification": sum(requests.values()) / (len(nodes) * len(groups)),
+        "retries": session.retry_policy.retries,
+        "refused": transport.refused,
+        "timeouts": transport.timeouts,
+        "states": dict(states),
+        "statuses": {group: status.name if status else None for group, status in result.statuses.items()},
+        "rollback_leftovers": sum(1 for node in nodes for group in failed
+                                  if (group in cluster.groups[node]) != before[(node, group)]),
+    }
+
+
+def simulate(action, nodes, groups, profile=None, down_nodes=0, present=0, **options):
+    # Runs the action on a fake cluster with the given FakeCluster profile, in virtual time
+    cluster = FakeCluster(**(profile or {}))
+    preload(cluster, nodes, groups, present)
+    transport = SimulatedTransport(cluster, down_nodes=down_nodes)
+    loop = VirtualClockLoop()
+    started_at = time.perf_counter()
+    try:
+        report = loop.run_until_complete(run_simulation(action, nodes, groups, cluster, transport, **options))
+    finally:
+        loop.close()
+    report["wall_time"] = time.perf_counter() - started_at
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from logs import setup_logging
+    from coroutine import parse_waves
+
+    parser = argparse.ArgumentParser(description='Run an action against a simulated cluster in virtual time')
+    parser.add_argument('--nodes', type=int, default=100000, help="Number of simulated nodes")
+    parser.add_argument('--groups', type=int, default=1, help="Number of groups of the run")
+    parser.add_argument('--action', type=str, default="create_group", choices=list(Coroutine.actions))
+    parser.add_argument('--latency', type=str, default="uniform:0.5,5",
+                        help="Latency of the nodes: fixed:<s>, uniform:<min>,<max> or exponential:<mean>")
+    parser.add_argument('--failure-rate', type=float, default=0.01, help="Ratio of requests answered with a 500")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the latency, failures and retries")
+    parser.add_argument('--slow-nodes', type=float, default=0, help="Ratio of slow nodes")
+    parser.add_argument('--slow-factor', type=float, default=10, help="Latency multiplier of the slow nodes")
+    parser.add_argument('--flaky-nodes', type=float, default=0, help="Ratio of flaky nodes")
+    parser.add_argument('--flaky-failure-rate', type=float, default=0.5, help="Failure rate of the flaky nodes")
+    parser.add_argument('--down-nodes', type=float, default=0, help="Ratio of nodes refusing connections")
+    parser.add_argument('--present', type=float, default=0, help="Ratio of nodes having the groups before the run")
+    parser.add_argument('--timeout', type=float, default=30, help="Total seconds of each request")
+    parser.add_argument('--concurrency', type=int, default=100, help="Max requests in flight")
+    parser.add_argument('--pipeline', action='store_true', help="Run Coroutine in pipeline mode")
+    parser.add_argument('--fail-fast', action='store_true', help="Run Coroutine in fail fast mode")
+    parser.add_argument('--waves', type=parse_waves, help="Run Coroutine in waves, e.g. 1,1%%,10%%,100%%")
+    parser.add_argument('--log-level', type=str, default="ERROR", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="Level of the run log")
+    parser.add_argument('--log-file', type=str, default="-", help="File of the run log, - for stderr")
+    parser.add_argument('--output', type=str, help="JSON file to save the report")
+    args = parser.parse_args()
+
+    logs = setup_logging(args.log_level, args.log_file)
+    report = simulate(
+        args.action, [f"http://node{i}.cluster" for i in range(args.nodes)], [f"group_{i}" for i in range(args.groups)],
+        profile={"latency": args.latency, "failure_rate": args.failure_rate, "seed": args.seed,
+                 "slow_nodes": args.slow_nodes, "slow_factor": args.slow_factor, "flaky_nodes": args.flaky_nodes,
+                 "flaky_failure_rate": args.flaky_failure_rate},
+        down_nodes=args.down_nodes, present=args.present, concurrency=args.concurrency, timeout=args.timeout,
+        seed=args.seed, pipeline=args.pipeline, fail_fast=args.fail_fast, waves=args.waves,
+    )
+    logs.stop()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,122 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class ClusterState():
+
+    version = 1
+
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        # group -> node -> [group is present, timestamp of the last time it was seen]
+        self.groups = {}
+
+    @classmethod
+    def load(cls, path, max_age=None):
+        state = cls(path, max_age=max_age)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return state
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unsupported state version in {path}")
+        state.groups = data["groups"]
+        return state
+
+    def get(self, node, group):
+        # None means unknown or stale, the node has to be checked
+        record = self.groups.get(group, {}).get(node)
+        if record is None:
+            return None
+        present, updated_at = record
+        if self.max_age is not None and time.time() - updated_at > self.max_age:
+            return None
+        return present
+
+    def set(self, node, group, present):
+        self.groups.setdefault(group, {})[node] = [present, time.time()]
+
+    def forget(self, node, group):
+        self.groups.get(group, {}).pop(node, None)
+
+    def save(self):
+        # Written aside and renamed so a crash never leaves a truncated state behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "groups": self.groups}, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+
+class StatusCache():
+
+    version = 1
+
+    def __init__(self, path=None, ttl=60, max_size=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        # (node, group) -> (group is present, timestamp), the least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._emptied = False
+
+    @classmethod
+    def load(cls, path, ttl=60, max_size=100000):
+        cache = cls(path, ttl=ttl, max_size=max_size)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cache
+        if data.get("version") != cls.version:
+            raise ValueError(f"Unsupported status cache version in {path}")
+        now = time.time()
+        for node, group, present, updated_at in data["entries"][-max_size:]:
+            if now - updated_at <= ttl:
+                cache.entries[(node, group)] = (present, updated_at)
+        return cache
+
+    def get(self, node, group):
+        # None means unknown or expired, the node has to be checked
+        key = (node, group)
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, node, group, present):
+        key = (node, group)
+        self.entries[key] = (present, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, node, group):
+        # A change may be on its way. The file is emptied before the first one, so a process dying before the next
+        # save does not leave the statuses from before the change behind
+        if self.path is not None and not self._emptied:
+            self._write({})
+            self._emptied = True
+        self.entries.pop((node, group), None)
+
+    def save(self):
+        self._write(self.entries)
+        self._emptied = False
+
+    def _write(self, entries):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "entries": [[node, group, present, updated_at] for (node, group), (
+                present, updated_at) in entries.items()]}, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
@@ -1,11 +1,34 @@
 import asyncio
+import io
+import json
+import os
+import runpy
+import sys
+import aiohttp
 import pytest
 
-from aioresponses import aioresponses
+from aiohttp import web
+from aioresponses import aioresponses, CallbackResult
+from yarl import URL
 from tenacity import stop_after_attempt, RetryError
 
-from node import NodeClient, NodeError, NodeGroupNotFound, CreateGroup, DeleteGroup, NodeActionState
-from main import Coroutine, CoroutineState
+from node import (NodeClient, NodeError, NodeGroupNotFound, CreateGroup, DeleteGroup, NodeActionState, NodeSession,
+                  NodeTable, NodeUnavailable, RetryPolicy, node_origin)
+import benchmark
+from app import FakeCluster, Http2Server
+from audit import AuditCoroutine
+from daemon import Daemon
+import journal
+from inventory import InventoryError, NodeSet, read_nodes, unique
+from coroutine import Coroutine, CoroutineState, parse_waves
+from main import non_negative_int
+from scoreboard import Scoreboard
+from shard import ShardedCoroutine
+import simulator
+import logs
+from metrics import Metrics
+from state import ClusterState, StatusCache
+from transport import Transport
 
 
 def test_node_create_group():
@@ -89,6 +112,201 @@ def test_node_delete_group_exception():
             loop.run_until_complete(NodeClient.delete_group(node, "group_1"))
 
 
+def test_node_shared_session():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession(limit_per_host=2)
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        mocker.post(node+"/v1/group", status=201, payload={"groupId": "group_1"})
+
+        loop.run_until_complete(NodeClient.get_group(node, "group_1", session=session))
+        client_session = session.session
+        loop.run_until_complete(NodeClient.create_group(node, "group_1", session=session))
+
+        assert session.session is client_session
+        assert client_session.connector.limit_per_host == 2
+
+    loop.run_until_complete(session.close())
+    assert client_session.closed
+
+
+def test_node_connection_error():
+
+    loop = asyncio.get_event_loop()
+
+    with aioresponses():
+        with pytest.raises(NodeError):
+            loop.run_until_complete(NodeClient.get_group("node1.cluster.com", "group_1"))
+
+
+def test_node_circuit_breaker():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession(breaker_threshold=2, breaker_cooldown=60)
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", status=500, repeat=True)
+        for _ in range(2):
+            with pytest.raises(NodeError):
+                loop.run_until_complete(NodeClient.get_group(node, "group_1", session=session))
+        with pytest.raises(NodeUnavailable):
+            loop.run_until_complete(NodeClient.get_group(node, "group_1", session=session))
+
+        assert len(mocker.requests[("GET", URL(node+"/v1/group/group_1"))]) == 2
+
+    loop.run_until_complete(session.close())
+
+
+def test_node_timeout():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession(timeouts={"GET": aiohttp.ClientTimeout(total=0.01)})
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", timeout=True)
+        with pytest.raises(NodeError) as error:
+            loop.run_until_complete(NodeClient.get_group(node, "group_1", session=session))
+
+        assert error.value.code is None
+        assert mocker.requests[("GET", URL(node+"/v1/group/group_1"))][0].kwargs["timeout"].total == 0.01
+
+    loop.run_until_complete(session.close())
+
+
+def test_node_hedged_get_group():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession(hedge_percentile=50, hedge_min_samples=1)
+    session.latencies["GET"].append(0.01)
+
+    calls = []
+
+    async def slow_first_call(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return CallbackResult(status=200, payload={"groupId": "group_1"})
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", callback=slow_first_call, repeat=True)
+        resp = loop.run_until_complete(asyncio.wait_for(NodeClient.get_group(node, "group_1", session=session), 1))
+
+        assert resp.status == 200
+        assert len(mocker.requests[("GET", URL(node+"/v1/group/group_1"))]) == 2
+
+    loop.run_until_complete(session.close())
+
+
+def test_node_hedged_request_cancelled_while_waiting():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession(hedge_percentile=50, hedge_min_samples=1)
+    session.latencies["GET"].append(1)
+    finished = []
+
+    async def slow_call(url, **kwargs):
+        await asyncio.sleep(0.2)
+        finished.append(url)
+        return CallbackResult(status=200, payload={"groupId": "group_1"})
+
+    async def cancel_caller():
+        request = asyncio.ensure_future(session.request(node, "GET", "/v1/group/group_1", hedge=True))
+        await asyncio.sleep(0.05)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        await asyncio.sleep(0.3)
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", callback=slow_call, repeat=True)
+        loop.run_until_complete(cancel_caller())
+
+    loop.run_until_complete(session.close())
+    # The request in flight was cancelled with its caller
+    assert finished == []
+
+
+def test_retry_policy():
+
+    policy = RetryPolicy(backoff=1, max_backoff=3, budget=0.5, min_retries=1)
+
+    assert 0 <= policy.wait(1) <= 1
+    assert 0 <= policy.wait(5) <= 3
+    assert policy.acquire_retry()
+    assert not policy.acquire_retry()
+    policy.requests = 2
+    assert policy.acquire_retry()
+
+
+def test_action_retry_budget():
+
+    loop = asyncio.get_event_loop()
+    node = "node1.cluster.com"
+    session = NodeSession(retry_policy=RetryPolicy(backoff=0, budget=0, min_retries=0))
+    action = CreateGroup(node, session=session)
+    action.get_current_status.retry.stop = stop_after_attempt(3)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=500, repeat=True)
+        with pytest.raises(NodeError):
+            loop.run_until_complete(action.get_current_status("group_1"))
+
+        assert action.status == NodeActionState.ERROR
+        assert len(mocker.requests[("GET", URL(node+"/v1/group/group_1"))]) == 1
+
+    loop.run_until_complete(session.close())
+
+
+def test_action_retry_budget_only_counts_retries():
+
+    loop = asyncio.get_event_loop()
+    node = "node1.cluster.com"
+    policy = RetryPolicy(backoff=0, budget=None)
+    session = NodeSession(retry_policy=policy)
+    action = CreateGroup(node, session=session)
+    action.get_current_status.retry.stop = stop_after_attempt(3)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=500, repeat=True)
+        with pytest.raises(RetryError):
+            loop.run_until_complete(action.get_current_status("group_1"))
+
+        # The last attempt is not retried, so it takes nothing from the budget
+        assert len(mocker.requests[("GET", URL(node+"/v1/group/group_1"))]) == 3
+        assert policy.retries == 2
+
+    loop.run_until_complete(session.close())
+
+
+def test_node_events_and_log_off_the_loop(tmp_path):
+
+    loop = asyncio.get_event_loop()
+    setup = logs.setup_logging("DEBUG", str(tmp_path / "run.log"), str(tmp_path / "events.jsonl"))
+
+    with aioresponses() as mocker:
+        node = "node1.cluster.com"
+        mocker.get(node+"/v1/group/group_1", status=404)
+        mocker.post(node+"/v1/group", status=201)
+        with pytest.raises(NodeGroupNotFound):
+            loop.run_until_complete(NodeClient.get_group(node, "group_1"))
+        loop.run_until_complete(NodeClient.create_group(node, "group_1"))
+    setup.stop()
+
+    records = [json.loads(line) for line in (tmp_path / "events.jsonl").read_text().splitlines()]
+    assert [(i["op"], i["code"], i.get("error")) for i in records] == [
+        ("get_group", 404, "NodeGroupNotFound"), ("create_group", 201, None)
+    ]
+    assert "DEBUG: Creating group group_1 on node1.cluster.com" in (tmp_path / "run.log").read_text()
+    assert not logs.events.isEnabledFor(logs.logging.INFO)
+
+
 def test_action_create_group_getstatus_not_needed():
 
     loop = asyncio.get_event_loop()
@@ -336,6 +554,189 @@ def test_coroutine_create_group_rolledback():
         assert coroutine.status == CoroutineState.ROLLED_BACK
 
 
+def test_coroutine_closes_own_session():
+
+    node = "node1.cluster.com"
+    coroutine = Coroutine("create_group", [node, "node2.cluster.com"], "group_1")
+    assert all(task.session is coroutine.session for task in coroutine.tasks)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=200)
+        mocker.get("node2.cluster.com/v1/group/group_1", status=200)
+        coroutine.run()
+        assert coroutine.session.transport._session is None
+
+
+def test_coroutine_bounded_concurrency():
+
+    loop = asyncio.get_event_loop()
+    coroutine = Coroutine("create_group", [], "group_1", concurrency=3)
+
+    class FakeTask():
+        group = "group_1"
+        in_flight = 0
+        peak = 0
+
+        def __init__(self, value):
+            self.value = value
+            self.row = value
+
+        async def forward(self, group_name):
+            FakeTask.in_flight += 1
+            FakeTask.peak = max(FakeTask.peak, FakeTask.in_flight)
+            await asyncio.sleep(0.001)
+            FakeTask.in_flight -= 1
+            if self.value == 5:
+                raise NodeError(group_name, 500, "")
+            return self.value
+
+    result = loop.run_until_complete(coroutine._forward([FakeTask(i) for i in range(10)]))
+
+    assert FakeTask.peak == 3
+    assert list(result) == [5]
+    assert isinstance(result[5], NodeError)
+
+
+def test_coroutine_multiple_groups_rollback_is_scoped():
+
+    node = "node1.cluster.com"
+    coroutine = Coroutine("create_group", [node], ["group_1", "group_2"])
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=404)
+        mocker.get(node+"/v1/group/group_2", status=404)
+        mocker.post(node+"/v1/group", status=201)
+        mocker.post(node+"/v1/group", status=500)
+        mocker.delete(node+"/v1/group", status=200)
+        coroutine.run()
+
+    assert [task.group for task in coroutine.tasks] == ["group_1", "group_2"]
+    assert coroutine.statuses == {"group_1": CoroutineState.DONE, "group_2": CoroutineState.ROLLED_BACK}
+    assert coroutine.status == CoroutineState.ROLLED_BACK
+
+
+def test_coroutine_pipeline_done():
+
+    nodes = ["node1.cluster.com", "node2.cluster.com"]
+    coroutine = Coroutine("create_group", nodes, "group_1", pipeline=True)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get(nodes[0]+"/v1/group/group_1", status=404)
+        mocker.get(nodes[1]+"/v1/group/group_1", status=200)
+        mocker.post(nodes[0]+"/v1/group", status=201)
+        coroutine.run()
+
+    assert coroutine.status == CoroutineState.DONE
+    assert [task.status for task in coroutine.tasks] == [NodeActionState.DONE, NodeActionState.NOT_NEEDED]
+
+
+def test_coroutine_pipeline_status_error_rolls_back():
+
+    nodes = ["node1.cluster.com", "node2.cluster.com"]
+    coroutine = Coroutine("create_group", nodes, "group_1", pipeline=True)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get(nodes[0]+"/v1/group/group_1", status=404)
+        mocker.get(nodes[1]+"/v1/group/group_1", status=500)
+        mocker.post(nodes[0]+"/v1/group", status=201)
+        mocker.delete(nodes[0]+"/v1/group", status=200)
+        coroutine.run()
+
+    assert coroutine.status == CoroutineState.ERROR
+    assert [task.status for task in coroutine.tasks] == [NodeActionState.ROLLED_BACK, NodeActionState.ERROR]
+
+
+def test_coroutine_run_async_shared_loop_and_session():
+
+    loop = asyncio.get_event_loop()
+    session = NodeSession()
+    nodes = ["node1.cluster.com", "node2.cluster.com"]
+    create = Coroutine("create_group", nodes, "group_1", session=session)
+    delete = Coroutine("delete_group", nodes, "group_2", session=session)
+
+    async def run_both():
+        return await asyncio.gather(create.run_async(), delete.run_async())
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", status=200)
+            mocker.get(node+"/v1/group/group_2", status=404)
+        created, deleted = loop.run_until_complete(run_both())
+
+    assert not session.transport._session.closed
+    loop.run_until_complete(session.close())
+    assert created.nodes == {"group_1": {"NOT_NEEDED": nodes}}
+    assert deleted.to_dict() == {"status": None, "groups": {"group_2": {"status": None, "nodes": {"NOT_NEEDED": nodes}, "errors": []}}}
+
+
+def test_coroutine_fail_fast_cancels_in_flight_forwards():
+
+    nodes = ["node1.cluster.com", "node2.cluster.com", "node3.cluster.com"]
+    coroutine = Coroutine("create_group", nodes, "group_1", concurrency=2, fail_fast=True)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    async def slow(url, **kwargs):
+        await asyncio.sleep(10)
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", status=404, repeat=True)
+        mocker.post(nodes[0]+"/v1/group", status=500)
+        mocker.post(nodes[1]+"/v1/group", callback=slow)
+        coroutine.run()
+
+        assert ("POST", URL(nodes[2]+"/v1/group")) not in mocker.requests
+        assert len(mocker.requests[("GET", URL(nodes[1]+"/v1/group/group_1"))]) == 2
+        assert ("DELETE", URL(nodes[1]+"/v1/group")) not in mocker.requests
+
+    assert coroutine.status == CoroutineState.ROLLED_BACK
+    assert [task.status for task in coroutine.tasks] == [NodeActionState.ERROR, NodeActionState.READY, NodeActionState.READY]
+
+
+def test_coroutine_metrics():
+
+    loop = asyncio.get_event_loop()
+    node = "node1.cluster.com"
+    metrics = Metrics()
+    session = NodeSession(metrics=metrics, retry_policy=RetryPolicy(backoff=0))
+    coroutine = Coroutine("create_group", [node], "group_1", session=session)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(2)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=404)
+        mocker.post(node+"/v1/group", status=500, repeat=True)
+        mocker.delete(node+"/v1/group", status=200)
+        coroutine.run()
+    loop.run_until_complete(session.close())
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+
+    data = metrics.to_dict()
+    assert set(data["phases"]) == {"status", "forward", "rollback"}
+    assert [(i["endpoint"], i["status"], i["count"]) for i in data["requests"]] == [
+        ("create_group", "500", 2), ("get_group", "404", 1)
+    ]
+    assert data["attempts"] == {"CreateGroup.get_current_status": 1, "CreateGroup.forward": 2}
+    assert data["retries"] == {"CreateGroup.forward": 1}
+    assert data["in_flight"]["max"] == 1
+
+    text = metrics.to_prometheus()
+    assert 'cluster_request_duration_seconds_count{endpoint="create_group",status="500"} 2' in text
+    assert 'cluster_request_duration_seconds_bucket{endpoint="get_group",status="404",le="+Inf"} 1' in text
+    assert 'cluster_retries_total{operation="CreateGroup.forward"} 1' in text
+
+
 def test_coroutine_delete_group_error_1():
 
     node = "node1.cluster.com"
@@ -375,3 +776,909 @@ def test_coroutine_delete_group_rolledback():
         mocker.delete(node+"/v1/group", status=500)
         coroutine.run()
         assert coroutine.status == CoroutineState.ROLLED_BACK
+
+
+def test_state_plan(tmp_path):
+
+    state = ClusterState(str(tmp_path / "state.json"))
+    state.set("node1.cluster.com", "group_1", True)
+    state.set("node2.cluster.com", "group_1", False)
+    coroutine = Coroutine("create_group", ["node1.cluster.com", "node2.cluster.com", "node3.cluster.com"], "group_1", state=state)
+
+    plan = coroutine.plan()
+
+    assert [task.node for task in plan["unchanged"]] == ["node1.cluster.com"]
+    assert [task.node for task in plan["change"]] == ["node2.cluster.com"]
+    assert [task.node for task in plan["unknown"]] == ["node3.cluster.com"]
+
+
+def test_state_apply_only_checks_unknown_nodes(tmp_path):
+
+    path = str(tmp_path / "state.json")
+    state = ClusterState(path)
+    state.set("node1.cluster.com", "group_1", False)
+    coroutine = Coroutine("create_group", ["node1.cluster.com", "node2.cluster.com"], "group_1", state=state, refresh=False)
+
+    with aioresponses() as mocker:
+        mocker.get("node2.cluster.com/v1/group/group_1", status=200)
+        mocker.post("node1.cluster.com/v1/group", status=201)
+        coroutine.run()
+
+    assert coroutine.status == CoroutineState.DONE
+    saved = ClusterState.load(path)
+    assert saved.get("node1.cluster.com", "group_1") is True
+    assert saved.get("node2.cluster.com", "group_1") is True
+    assert ClusterState.load(path, max_age=-1).get("node1.cluster.com", "group_1") is None
+
+
+def test_benchmark_against_fake_cluster():
+
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        runner = web.AppRunner(FakeCluster(latency="uniform:0,0.001", failure_rate=0, seed=1).app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        nodes = [f"http://127.0.0.1:{port}/{i}" for i in range(5)]
+        try:
+            return await benchmark.run_action("create_group", nodes, ["group_1"], 2, False, False)
+        finally:
+            await runner.cleanup()
+
+    report = loop.run_until_complete(run())
+
+    assert report["status"] == "DONE"
+    assert report["requests"] == 10
+    assert report["phases"]["status"]["requests"] == 5
+    assert report["phases"]["forward"]["requests"] == 5
+    assert report["latency"]["p50"] <= report["latency"]["p99"]
+
+
+def test_fake_cluster_is_deterministic_and_counts_requests():
+
+    loop = asyncio.get_event_loop()
+
+    async def run(cluster):
+        runner = web.AppRunner(cluster.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for node in range(20):
+                    async with session.post(f"{url}/{node}/v1/group", json={"groupId": "group_1"}) as response:
+                        statuses.append(response.status)
+                    async with session.get(f"{url}/{node}/v1/group/group_1") as response:
+                        statuses.append(response.status)
+                async with session.get(f"{url}/_stats") as response:
+                    return statuses, await response.json()
+        finally:
+            await runner.cleanup()
+
+    first, stats = loop.run_until_complete(run(FakeCluster(latency="fixed:0", failure_rate=0.3, seed=7)))
+    second, _ = loop.run_until_complete(run(FakeCluster(latency="fixed:0", failure_rate=0.3, seed=7)))
+
+    assert first == second
+    assert 500 in first and 201 in first
+    assert stats["nodes"] == 20
+    assert stats["requests"] == {"get": 20, "create": 20, "delete": 0}
+
+
+def test_sharded_coroutine_rolls_back_every_shard():
+
+    loop = asyncio.get_event_loop()
+    cluster = FakeCluster(latency="fixed:0", failure_rate=0)
+    metrics = Metrics()
+    session = NodeSession(metrics=metrics)
+
+    async def run():
+        runner = web.AppRunner(cluster.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        nodes = [f"{url}/{i}" for i in range(5)]
+        try:
+            done = await ShardedCoroutine("create_group", nodes, "group_1", shards=3, session=session).run_async()
+            # No route matches a nested path: its status is 404 (READY) and creating the group fails
+            rolled_back = await ShardedCoroutine("create_group", nodes + [f"{url}/bad/node"], "group_2", shards=3).run_async()
+            return done, rolled_back
+        finally:
+            await runner.cleanup()
+
+    done, rolled_back = loop.run_until_complete(run())
+
+    assert done.status == CoroutineState.DONE
+    assert len(done.nodes["group_1"]["DONE"]) == 5
+    # The requests of every shard end up in the metrics of the coordinator
+    assert sum(histogram.count for histogram in metrics.requests.values()) == 10
+    assert sorted(metrics.attempts.values()) == [5, 5] and 0 < metrics.in_flight_max <= 10
+    assert set(metrics.phases) == {"status", "forward"}
+    assert rolled_back.status == CoroutineState.ROLLED_BACK
+    assert len(rolled_back.nodes["group_2"]["ROLLED_BACK"]) == 5
+    assert all("group_2" not in groups for groups in cluster.groups.values())
+    assert sum("group_1" in groups for groups in cluster.groups.values()) == 5
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+@pytest.mark.parametrize("content", [
+    '[\n  "node1.cluster.com",\n  "node2.cluster.com" , "node3.cluster.com"]\n',
+    '"node1.cluster.com"\n\n"node2.cluster.com"\n"node3.cluster.com"',
+    'node1.cluster.com\nnode2.cluster.com\n\nnode3.cluster.com\n',
+])
+def test_read_nodes(content, chunk_size):
+
+    assert list(read_nodes(io.StringIO(content), chunk_size)) == ["node1.cluster.com", "node2.cluster.com", "node3.cluster.com"]
+
+
+@pytest.mark.parametrize("content,message", [
+    ('{"node": "node1.cluster.com"}', "Root element must be a list"),
+    ('["node1.cluster.com", 1]', "Nodes must be a string"),
+    ('["node1.cluster.com" "node2.cluster.com"]', "File can not be readed"),
+    ('["node1.cluster.com", ', "File can not be readed"),
+    ('"node1.cluster.com"\n{"node": 1}', "Nodes must be a string"),
+    ('5\n', "Root element must be a list"),
+    ('null', "Root element must be a list"),
+    ('node1.cluster.com\nnode2 is down\n', "Node is not a URL"),
+    ('\x00\x01\x02', "Node is not a URL"),
+])
+def test_read_nodes_errors(content, message):
+
+    with pytest.raises(InventoryError, match=message):
+        list(read_nodes(io.StringIO(content), 4))
+
+
+def test_unique_nodes(monkeypatch):
+
+    nodes = [f"node{i}.cluster.com" for i in range(5000)]
+    assert list(unique(nodes + nodes[::-1] + nodes)) == nodes
+    assert list(read_nodes(io.StringIO("10.0.0.1\nnull.example.com\n"))) == ["10.0.0.1", "null.example.com"]
+
+    # Nodes sharing a hash are still told apart
+    monkeypatch.setattr(NodeSet, "hash", staticmethod(lambda node: 7 + len(node) % 2))
+    assert list(unique(nodes[:100] + nodes[:100])) == nodes[:100]
+
+    # A table checks the duplicates against the nodes it already keeps
+    table = NodeTable(["group_1"])
+    assert [table.add_node(node) for node in nodes[:3] + nodes[:2]] == [0, 1, 2, None, None]
+    assert table.nodes == nodes[:3] and table._node_set.nodes is table.nodes
+
+
+def test_coroutine_streams_nodes():
+
+    read = []
+
+    def stream():
+        # The duplicate is dropped by the run
+        for node in ("node1.cluster.com", "node2.cluster.com", "node1.cluster.com"):
+            read.append(node)
+            yield node
+
+    coroutine = Coroutine("create_group", stream(), "group_1", concurrency=1)
+    CreateGroup.forward.retry.stop = stop_after_attempt(1)
+    CreateGroup.get_current_status.retry.stop = stop_after_attempt(1)
+
+    assert len(coroutine.tasks) == 0 and read == []
+
+    def status(url, **kwargs):
+        # The second node is read only once the first request is done
+        assert read == ["node1.cluster.com"] if "node1" in str(url) else read == ["node1.cluster.com", "node2.cluster.com"]
+        return CallbackResult(status=404)
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", callback=status)
+        mocker.get("node2.cluster.com/v1/group/group_1", callback=status)
+        mocker.post("node1.cluster.com/v1/group", status=201)
+        mocker.post("node2.cluster.com/v1/group", status=201)
+        coroutine.run()
+
+    assert coroutine.status == CoroutineState.DONE
+    assert [task.node for task in coroutine.tasks] == ["node1.cluster.com", "node2.cluster.com"]
+
+
+def test_coroutine_broken_stream_rolls_back():
+
+    coroutine = Coroutine("create_group", read_nodes(io.StringIO('["node1.cluster.com", 2]'), 4), "group_1",
+                          pipeline=True, concurrency=1)
+    CreateGroup.forward.retry.stop = stop_after_attempt(1)
+    CreateGroup.backward.retry.stop = stop_after_attempt(1)
+    CreateGroup.get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=404)
+        mocker.post("node1.cluster.com/v1/group", status=201)
+        mocker.delete("node1.cluster.com/v1/group", status=200)
+        coroutine.run()
+
+    assert coroutine.status == CoroutineState.ERROR
+    assert [task.status for task in coroutine.tasks] == [NodeActionState.ROLLED_BACK]
+
+
+def test_node_table_select():
+
+    table = NodeTable(["group_1", "group_2"])
+    nodes = [table.add_node(node) for node in ("node1.cluster.com", "node2.cluster.com", "node3.cluster.com")]
+    rows = [table.add(node, group) for group in (0, 1) for node in nodes]
+    for row, status in zip(rows, [NodeActionState.READY, NodeActionState.DONE, NodeActionState.READY,
+                                  NodeActionState.READY, None, NodeActionState.UNKNOWN]):
+        table.set_status(row, status)
+
+    assert list(table.select([NodeActionState.READY])) == [0, 2, 3]
+    assert list(table.select([NodeActionState.READY], groups={"group_2"})) == [3]
+    assert list(table.select([NodeActionState.DONE, NodeActionState.UNKNOWN], rows=[1, 2, 5])) == [1, 5]
+    assert table.groups_of([0, 4]) == {"group_1", "group_2"}
+    assert table.nodes_by_state() == {
+        "group_1": {"READY": ["node1.cluster.com", "node3.cluster.com"], "DONE": ["node2.cluster.com"]},
+        "group_2": {"READY": ["node1.cluster.com"], "PENDING": ["node2.cluster.com"], "UNKNOWN": ["node3.cluster.com"]},
+    }
+
+
+def test_coroutine_tasks_are_views_of_the_table():
+
+    coroutine = Coroutine("delete_group", ["node1.cluster.com", "node2.cluster.com"], ["group_1", "group_2"])
+
+    task = coroutine.tasks[-1]
+    assert isinstance(task, DeleteGroup) and not hasattr(task, "__dict__")
+    assert (task.node, task.group, task.status) == ("node2.cluster.com", "group_2", None)
+
+    task.status = NodeActionState.READY
+    assert coroutine.tasks[3].status == NodeActionState.READY
+    assert coroutine.table.nodes == ["node1.cluster.com", "node2.cluster.com"]
+    assert len(coroutine.tasks) == 4
+
+
+def test_non_negative_int():
+
+    assert non_negative_int("0") == 0
+    assert non_negative_int("5") == 5
+    with pytest.raises(ValueError):
+        non_negative_int("-1")
+
+
+def test_parse_waves():
+
+    assert parse_waves("1, 1%,10%,100%") == [1, 0.01, 0.1, 1.0]
+    with pytest.raises(ValueError):
+        parse_waves("1,0%")
+    coroutine = Coroutine("create_group", [], "group_1", waves=parse_waves("1,1%,10%,100%"))
+    assert coroutine._wave_ends(1000) == [1, 10, 100, 1000]
+    assert coroutine._wave_ends(50) == [1, 5, 50]
+    assert coroutine._wave_ends(0) == []
+
+
+def test_coroutine_waves_stop_at_the_failing_wave():
+
+    nodes = [f"node{i}.cluster.com" for i in range(10)]
+    coroutine = Coroutine("create_group", nodes, "group_1", waves=[1, 0.3, 1.0])
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        for i, node in enumerate(nodes):
+            mocker.get(node+"/v1/group/group_1", status=404)
+            mocker.post(node+"/v1/group", status=500 if i == 2 else 201)
+            mocker.delete(node+"/v1/group", status=200)
+        coroutine.run()
+        requests = [(method, str(url).split("/")[0]) for method, url in mocker.requests]
+
+    assert coroutine.status == CoroutineState.ROLLED_BACK
+    assert sorted(host for method, host in requests if method == "POST") == nodes[:3]
+    assert sorted(host for method, host in requests if method == "DELETE") == nodes[:2]
+    assert coroutine.nodes_by_state()["group_1"] == {"ROLLED_BACK": nodes[:2], "ERROR": nodes[2:3], "READY": nodes[3:]}
+
+
+def test_status_cache_ttl_and_lru(tmp_path):
+
+    path = str(tmp_path / "cache.json")
+    cache = StatusCache(path, ttl=60, max_size=2)
+    cache.set("node1.cluster.com", "group_1", True)
+    cache.set("node2.cluster.com", "group_1", False)
+    assert cache.get("node1.cluster.com", "group_1") is True
+    cache.set("node3.cluster.com", "group_1", True)
+
+    # node2 was the least recently used
+    assert cache.get("node2.cluster.com", "group_1") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.save()
+
+    assert list(StatusCache.load(path).entries) == [("node1.cluster.com", "group_1"), ("node3.cluster.com", "group_1")]
+    assert StatusCache.load(path, max_size=1).get("node3.cluster.com", "group_1") is True
+    assert StatusCache.load(path, ttl=-1).entries == {}
+
+    # Killed during a change, nothing from before it is read back
+    cache = StatusCache.load(path)
+    cache.invalidate("node1.cluster.com", "group_1")
+    assert StatusCache.load(path).entries == {}
+    cache.save()
+    assert list(StatusCache.load(path).entries) == [("node3.cluster.com", "group_1")]
+
+
+def test_status_cache_skips_recent_probes():
+
+    loop = asyncio.get_event_loop()
+    cache = StatusCache()
+    session = NodeSession(status_cache=cache)
+    node = "node1.cluster.com"
+    CreateGroup.forward.retry.stop = stop_after_attempt(1)
+    CreateGroup.get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get(node+"/v1/group/group_1", status=404)
+        mocker.post(node+"/v1/group", status=201)
+        mocker.post(node+"/v1/group", status=500)
+        action = CreateGroup(node, session=session)
+        loop.run_until_complete(action.get_current_status("group_1"))
+        loop.run_until_complete(action.forward("group_1"))
+
+        # The second status comes from the cache: there is no mock left for it
+        action = CreateGroup(node, session=session)
+        loop.run_until_complete(action.get_current_status("group_1"))
+        assert action.status == NodeActionState.NOT_NEEDED
+        assert cache.get(node, "group_1") is True
+
+        with pytest.raises(RetryError):
+            loop.run_until_complete(action.forward("group_1"))
+        assert cache.get(node, "group_1") is None
+
+    loop.run_until_complete(session.close())
+
+
+def test_daemon_coalesces_jobs_on_a_warm_session():
+
+    loop = asyncio.get_event_loop()
+    cluster = FakeCluster(latency="fixed:0", failure_rate=0)
+    daemon = Daemon(NodeSession(), batch_window=0.05)
+
+    async def run():
+        runners = []
+        urls = []
+        for app in (cluster.app(), daemon.app()):
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            runners.append(runner)
+            urls.append(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}")
+        nodes = [f"{urls[0]}/a", f"{urls[0]}/b"]
+        try:
+            async with aiohttp.ClientSession() as client:
+                async with client.post(f"{urls[1]}/jobs", json={"action": "create_group", "group": "group_1", "nodes": nodes}) as r:
+                    create = await r.json()
+                # Same batch: the delete of node b wins over its create
+                job = {"action": "delete_group", "group": "group_1", "nodes": nodes[1:], "wait": True}
+                async with client.post(f"{urls[1]}/jobs", json=job) as r:
+                    delete = await r.json()
+                async with client.get(f"{urls[1]}/jobs/{create['id']}?wait") as r:
+                    create = await r.json()
+                pool = daemon.session.session
+                job = {"action": "delete_group", "group": ["group_1"], "nodes": nodes[:1], "wait": True}
+                async with client.post(f"{urls[1]}/jobs", json=job) as r:
+                    second = await r.json()
+                invalid = set()
+                for job in ({"action": "create_group"}, {"action": "create_group", "group": "g", "nodes": [1, 2]},
+                            {"action": "create_group", "group": "g", "nodes": "http://x"},
+                            {"action": "create_group", "group": [1], "nodes": nodes}):
+                    async with client.post(f"{urls[1]}/jobs", json=job) as r:
+                        invalid.add(r.status)
+                return nodes, create, delete, second, invalid, pool is daemon.session.session
+        finally:
+            for runner in reversed(runners):
+                await runner.cleanup()
+
+    nodes, create, delete, second, invalid, warm = loop.run_until_complete(run())
+
+    assert create["status"] == "DONE"
+    assert create["groups"]["group_1"] == {"DONE": nodes[:1], "SUPERSEDED": nodes[1:]}
+    assert delete["status"] == "DONE" and list(delete["groups"]["group_1"]) == ["NOT_NEEDED"]
+    assert second["status"] == "DONE" and list(second["groups"]["group_1"]) == ["DONE"]
+    assert invalid == {400}
+    assert warm
+    assert all("group_1" not in groups for groups in cluster.groups.values())
+
+
+def test_daemon_batch_shares_one_window():
+
+    class CountingTransport(Transport):
+
+        def __init__(self):
+            self.in_flight = 0
+            self.peak = 0
+
+        async def request(self, method, url, timeout=None, **kwargs):
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            try:
+                await asyncio.sleep(0.01)
+            finally:
+                self.in_flight -= 1
+            if method == "GET":
+                return simulator.SimulatedResponse(404, ""), ""
+            if url.startswith("http://bad"):
+                return simulator.SimulatedResponse(500, "down"), "down"
+            return simulator.SimulatedResponse(201 if method == "POST" else 200, ""), ""
+
+        async def close(self):
+            pass
+
+    transport = CountingTransport()
+    daemon = Daemon(NodeSession(transport=transport, retry_policy=RetryPolicy(budget=0)), concurrency=2)
+
+    async def run():
+        daemon._wake = asyncio.Event()
+        jobs = [daemon.submit("create_group", [f"http://node{i}.cluster.com" for i in range(5)], [f"group_{job}"])
+                for job in range(3)]
+        jobs.append(daemon.submit("create_group", ["http://node0.cluster.com", "http://bad.cluster.com"], ["group_3"]))
+        await daemon._run_batch(daemon.pending, daemon.waiting)
+        return jobs
+
+    jobs = asyncio.get_event_loop().run_until_complete(run())
+
+    # Four runs at once, but never more requests in flight than the window of the daemon
+    assert transport.peak == 2
+    assert [job.status for job in jobs] == ["DONE", "DONE", "DONE", "ROLLED_BACK"]
+    assert jobs[3].errors == ["ERROR 500 in http://bad.cluster.com: down"]
+
+
+def test_daemon_survives_failing_runs(monkeypatch):
+
+    class Failing(Coroutine):
+
+        def __init__(self, action, nodes, group, **kwargs):
+            if group == "bad":
+                raise RuntimeError("Can not start")
+            super().__init__(action, nodes, group, **kwargs)
+
+    daemon = Daemon(NodeSession(), batch_window=0)
+    monkeypatch.setattr("daemon.Coroutine", Failing)
+
+    async def broken(batch, jobs):
+        raise RuntimeError("Broken batch")
+
+    async def run():
+        daemon._wake = asyncio.Event()
+        runner = asyncio.ensure_future(daemon.run_forever())
+        try:
+            jobs = [daemon.submit("create_group", ["node1.cluster.com"], [group]) for group in ("good", "bad")]
+            await asyncio.gather(*[job.done.wait() for job in jobs])
+            # A whole batch failing does not stop the next ones
+            with monkeypatch.context() as patch:
+                patch.setattr(daemon, "_run_batch", broken)
+                jobs.append(daemon.submit("create_group", ["node1.cluster.com"], ["good"]))
+                await jobs[-1].done.wait()
+            jobs.append(daemon.submit("create_group", ["node1.cluster.com"], ["good"]))
+            await jobs[-1].done.wait()
+            return jobs
+        finally:
+            runner.cancel()
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/good", status=200, payload={"groupId": "good"}, repeat=True)
+        jobs = asyncio.get_event_loop().run_until_complete(run())
+    asyncio.get_event_loop().run_until_complete(daemon.session.close())
+
+    assert [job.status for job in jobs] == ["DONE", "ERROR", "ERROR", "DONE"]
+    assert jobs[1].errors == ["Can not start"]
+
+
+def test_journal_group_commit(tmp_path, monkeypatch):
+
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "journal.jsonl")
+    fsyncs = []
+    monkeypatch.setattr(journal.os, "fsync", lambda fd: fsyncs.append(fd))
+
+    async def run():
+        log = journal.Journal(path)
+        await log.commit({"event": "run", "action": "create_group", "groups": ["group_1"]})
+
+        async def change(i):
+            await log.commit({"event": "start", "op": "forward", "node": f"node{i}", "group": "group_1"})
+            log.append({"event": "done", "op": "forward", "node": f"node{i}", "group": "group_1"})
+
+        await asyncio.gather(*[change(i) for i in range(50)])
+        await log.close()
+
+    loop.run_until_complete(run())
+    with open(path, "a") as f:
+        f.write('{"event": "start", "op": "back')
+
+    run, operations, planned, ended = journal.load(path)
+    assert run["action"] == "create_group" and not ended and planned == {}
+    assert len(operations) == 50 and set(operations.values()) == {("forward", "done")}
+    # Every start record waited for the disk, but most of them shared a write
+    assert len(fsyncs) < 10
+
+
+@pytest.mark.parametrize("rollback", [False, True])
+def test_resume_only_touches_unknown_nodes(tmp_path, rollback):
+
+    path = str(tmp_path / "journal.jsonl")
+    with open(path, "w") as f:
+        for record in ({"event": "run", "action": "create_group", "groups": ["group_1"]},
+                       {"event": "planned", "nodes": {"group_1": ["node1.cluster.com", "node2.cluster.com",
+                                                                  "node3.cluster.com"]}},
+                       {"event": "start", "op": "forward", "node": "node1.cluster.com", "group": "group_1"},
+                       {"event": "start", "op": "forward", "node": "node2.cluster.com", "group": "group_1"},
+                       {"event": "done", "op": "forward", "node": "node1.cluster.com", "group": "group_1"}):
+            f.write(json.dumps(record) + "\n")
+
+    session = NodeSession(journal=journal.Journal(path, append=True))
+    coroutine = journal.ResumedCoroutine(path, session, rollback=rollback)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].backward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        # The change never reached node2, and the run died before starting node3
+        for node in ("node2.cluster.com", "node3.cluster.com"):
+            mocker.get(f"{node}/v1/group/group_1", status=404)
+            mocker.post(f"{node}/v1/group", status=201)
+        mocker.delete("node1.cluster.com/v1/group", status=200)
+        coroutine.run()
+        requests = sorted((method, str(url)) for method, url in mocker.requests)
+
+    asyncio.get_event_loop().run_until_complete(session.journal.close())
+    asyncio.get_event_loop().run_until_complete(session.close())
+    if rollback:
+        assert coroutine.status == CoroutineState.ROLLED_BACK
+        assert requests == [("DELETE", "node1.cluster.com/v1/group"), ("GET", "node2.cluster.com/v1/group/group_1")]
+    else:
+        assert coroutine.status == CoroutineState.DONE
+        assert requests == [("GET", "node2.cluster.com/v1/group/group_1"), ("GET", "node3.cluster.com/v1/group/group_1"),
+                            ("POST", "node2.cluster.com/v1/group"), ("POST", "node3.cluster.com/v1/group")]
+    assert journal.load(path)[3]
+    assert journal.ResumedCoroutine(path, NodeSession()).ended
+
+
+@pytest.mark.parametrize("rollback", [False, True])
+def test_resume_does_not_trust_the_status_cache(tmp_path, rollback):
+
+    path = str(tmp_path / "journal.jsonl")
+    with open(path, "w") as f:
+        for record in ({"event": "run", "action": "create_group", "groups": ["group_1"]},
+                       {"event": "planned", "nodes": {"group_1": ["node1.cluster.com"]}},
+                       {"event": "start", "op": "forward", "node": "node1.cluster.com", "group": "group_1"}):
+            f.write(json.dumps(record) + "\n")
+    # Saved before the change, which did reach the node
+    cache = StatusCache()
+    cache.set("node1.cluster.com", "group_1", False)
+    session = NodeSession(status_cache=cache)
+    coroutine = journal.ResumedCoroutine(path, session, rollback=rollback)
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        mocker.delete("node1.cluster.com/v1/group", status=200)
+        coroutine.run()
+        requests = sorted((method, str(url)) for method, url in mocker.requests)
+
+    asyncio.get_event_loop().run_until_complete(session.close())
+    if rollback:
+        assert coroutine.status == CoroutineState.ROLLED_BACK
+        assert requests == [("DELETE", "node1.cluster.com/v1/group"), ("GET", "node1.cluster.com/v1/group/group_1")]
+    else:
+        assert coroutine.status == CoroutineState.DONE
+        assert requests == [("GET", "node1.cluster.com/v1/group/group_1")]
+        assert coroutine.nodes_by_state() == {"group_1": {"DONE": ["node1.cluster.com"]}}
+
+
+def test_resume_without_planned_nodes_is_incomplete(tmp_path):
+
+    path = str(tmp_path / "journal.jsonl")
+    nodes = ["node1.cluster.com", "node2.cluster.com"]
+    session = NodeSession(journal=journal.Journal(path))
+    coroutine = Coroutine("create_group", nodes, ["group_1", "group_2"], session=session)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=404)
+        mocker.post("node1.cluster.com/v1/group", status=201)
+        for node in nodes:
+            mocker.get(f"{node}/v1/group/group_2", status=200, payload={"groupId": "group_2"})
+        mocker.get("node2.cluster.com/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        coroutine.run()
+
+    asyncio.get_event_loop().run_until_complete(session.journal.close())
+    asyncio.get_event_loop().run_until_complete(session.close())
+    # Only the nodes to change are planned
+    assert journal.load(path)[2] == {"group_1": {"node1.cluster.com": None}, "group_2": {}}
+
+    # Like a pipeline run, the journal has no planned record: the nodes it did not reach are unknown
+    with open(path, "w") as f:
+        for record in ({"event": "run", "action": "create_group", "groups": ["group_1"]},
+                       {"event": "start", "op": "forward", "node": "node1.cluster.com", "group": "group_1"},
+                       {"event": "done", "op": "forward", "node": "node1.cluster.com", "group": "group_1"}):
+            f.write(json.dumps(record) + "\n")
+    session = NodeSession()
+    coroutine = journal.ResumedCoroutine(path, session)
+    coroutine.run()
+    asyncio.get_event_loop().run_until_complete(session.close())
+    assert coroutine.status == CoroutineState.ERROR
+    assert coroutine.errors == {"group_1": ["Nodes not reached by the interrupted run are unknown"]}
+    assert coroutine.nodes_by_state() == {"group_1": {"DONE": ["node1.cluster.com"]}}
+
+
+def test_scoreboard_save_and_load(tmp_path):
+
+    path = str(tmp_path / "scoreboard")
+    scoreboard = Scoreboard(path, alpha=0.5)
+    scoreboard.record("node1.cluster.com", 1.0, True)
+    scoreboard.record("node1.cluster.com", 3.0, False)
+    scoreboard.record("node2.cluster.com", 0.5, True)
+    scoreboard.save()
+
+    loaded = Scoreboard.load(path)
+    assert loaded.nodes == ["node1.cluster.com", "node2.cluster.com"]
+    assert list(loaded.latency) == [2.0, 0.5] and list(loaded.error_rate) == [0.5, 0.0]
+    assert loaded.last_seen[0] > 0
+    # Expected time: latency / (1 - error rate), unknown nodes get the average
+    assert loaded.scores(["node1.cluster.com", "node2.cluster.com", "node3.cluster.com"]) == [4.0, 0.5, 2.25]
+    assert Scoreboard.load(str(tmp_path / "missing")).nodes == []
+    with open(path, "wb") as f:
+        f.write(b"SCB1")
+    with pytest.raises(ValueError):
+        Scoreboard.load(path)
+
+
+def test_coroutine_runs_slowest_nodes_first():
+
+    scoreboard = Scoreboard()
+    scoreboard.record("node1.cluster.com", 0.1, True)
+    scoreboard.record("node3.cluster.com", 1.0, True)
+    nodes = ["node1.cluster.com", "node2.cluster.com", "node3.cluster.com"]
+    coroutine = Coroutine("create_group", nodes, "group_1", session=NodeSession(scoreboard=scoreboard), concurrency=1)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", status=404)
+            mocker.post(node+"/v1/group", status=201)
+        coroutine.run()
+        order = [(method, str(url).split("/")[0]) for method, url in mocker.requests]
+
+    asyncio.get_event_loop().run_until_complete(coroutine.session.close())
+    # The requests of the status phase update the scoreboard, so only its order is known up front
+    assert order[:3] == [("GET", "node3.cluster.com"), ("GET", "node2.cluster.com"), ("GET", "node1.cluster.com")]
+    assert set(scoreboard.nodes) == set(nodes)
+
+
+def test_node_origin():
+
+    assert node_origin("http://10.0.0.1:8080/shard/1") == "http://10.0.0.1:8080"
+    assert node_origin("https://node1.cluster.com") == "https://node1.cluster.com"
+    assert node_origin("node1.cluster.com/shard/2") == "node1.cluster.com"
+
+
+def test_coroutine_interleaves_origins():
+
+    nodes = ["node1.cluster.com/a", "node1.cluster.com/b", "node1.cluster.com/c", "node2.cluster.com/a"]
+    coroutine = Coroutine("create_group", nodes, "group_1", session=NodeSession(), concurrency=1)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", status=404)
+            mocker.post(node+"/v1/group", status=201)
+        coroutine.run()
+        order = [str(url).split("/v1")[0] for method, url in mocker.requests if method == "GET"]
+
+    asyncio.get_event_loop().run_until_complete(coroutine.session.close())
+    assert coroutine.status == CoroutineState.DONE
+    assert order == ["node1.cluster.com/a", "node2.cluster.com/a", "node1.cluster.com/b", "node1.cluster.com/c"]
+
+
+def test_session_origin_limit():
+
+    in_flight = {}
+    peaks = {}
+
+    async def callback(url, **kwargs):
+        origin = str(url).split("/")[0]
+        in_flight[origin] = in_flight.get(origin, 0) + 1
+        peaks[origin] = max(peaks.get(origin, 0), in_flight[origin])
+        await asyncio.sleep(0.01)
+        in_flight[origin] -= 1
+        return CallbackResult(status=404)
+
+    nodes = [f"node{i % 2}.cluster.com/{i}" for i in range(8)]
+    session = NodeSession(origin_limit=2)
+    coroutine = Coroutine("create_group", nodes, "group_1", session=session, concurrency=8)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", callback=callback)
+        asyncio.get_event_loop().run_until_complete(coroutine._status_phase())
+
+    asyncio.get_event_loop().run_until_complete(session.close())
+    assert peaks == {"node0.cluster.com": 2, "node1.cluster.com": 2}
+
+
+def test_http2_transport_multiplexes_nodes_on_one_connection():
+
+    from transport import Http2Transport
+
+    async def run(cluster, server):
+        port = await server.start()
+        nodes = [f"http://127.0.0.1:{port}/{i}" for i in range(20)]
+        session = NodeSession(transport=Http2Transport())
+        try:
+            coroutine = Coroutine("create_group", nodes, "group_1", session=session, concurrency=20)
+            await coroutine.run_async()
+            response = await NodeClient.get_group(nodes[0], "group_1", session=session)
+            return coroutine, response.http_version, await response.json()
+        finally:
+            await session.close()
+            await server.close()
+
+    cluster = FakeCluster(latency="fixed:0.01", failure_rate=0)
+    server = Http2Server(cluster)
+    coroutine, version, data = asyncio.get_event_loop().run_until_complete(run(cluster, server))
+
+    assert coroutine.status == CoroutineState.DONE
+    assert (version, data) == ("HTTP/2", {"groupId": "group_1"})
+    assert cluster.stats()["requests"] == {"get": 21, "create": 20, "delete": 0}
+    assert (server.connections, server.streams) == (1, 41)
+
+
+def test_virtual_clock_loop():
+
+    loop = simulator.VirtualClockLoop()
+
+    async def sleeps():
+        await asyncio.gather(asyncio.sleep(3600), asyncio.sleep(60))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.sleep(100), 10)
+        return loop.time()
+
+    try:
+        assert loop.run_until_complete(sleeps()) == pytest.approx(3610)
+    finally:
+        loop.close()
+
+
+def test_simulation_in_virtual_time():
+
+    nodes = [f"http://node{i}.cluster" for i in range(2000)]
+    report = simulator.simulate("create_group", nodes, ["group_1"], profile={"latency": "uniform:1,5", "failure_rate": 0},
+                                concurrency=100)
+
+    assert report["status"] == "DONE"
+    assert report["requests"] == {"get": 2000, "create": 2000, "delete": 0}
+    assert report["amplification"] == 2
+    # 4000 requests of 1 to 5 seconds, 100 at a time
+    assert 40 < report["makespan"] < 200
+    assert report["wall_time"] < report["makespan"] / 10
+
+
+def test_simulation_is_deterministic_and_reports_rollbacks():
+
+    # Other tests change the attempts of the actions, the default ones are restored
+    for action in (CreateGroup, DeleteGroup):
+        for method in (action.forward, action.backward, action.get_current_status):
+            method.retry.stop = stop_after_attempt(3)
+    nodes = [f"http://node{i}.cluster" for i in range(500)]
+
+    def run():
+        report = simulator.simulate("delete_group", nodes, ["group_1"], profile={"latency": "exponential:0.5",
+                                    "failure_rate": 0.05, "seed": 3}, down_nodes=0.01, present=0.5, pipeline=True,
+                                    timeout=2, seed=3)
+        del report["wall_time"]
+        return report
+
+    first = run()
+    assert first == run()
+    assert first["status"] != "DONE"
+    assert first["refused"] > 0 and first["timeouts"] > 0
+    # delete_group rolls back by creating the group again
+    assert first["requests"]["create"] > 0
+    assert first["rollback_leftovers"] <= first["states"].get("ERROR", 0)
+
+
+def test_audit_reports_and_repairs_drifted_nodes():
+
+    nodes = ["node1.cluster.com", "node2.cluster.com", "node3.cluster.com", "node4.cluster.com"]
+    report = io.StringIO()
+    coroutine = AuditCoroutine(nodes, "group_1", report, repair=True, session=NodeSession(), concurrency=2)
+    coroutine.tasks[0].forward.retry.stop = stop_after_attempt(1)
+    coroutine.tasks[0].get_current_status.retry.stop = stop_after_attempt(1)
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        mocker.get("node2.cluster.com/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        mocker.get("node3.cluster.com/v1/group/group_1", status=404)
+        mocker.get("node4.cluster.com/v1/group/group_1", status=500)
+        mocker.post("node3.cluster.com/v1/group", status=201)
+        coroutine.run()
+        requests = sorted((method, str(url)) for method, url in mocker.requests)
+
+    asyncio.get_event_loop().run_until_complete(coroutine.session.close())
+    lines = [json.loads(line) for line in report.getvalue().splitlines()]
+    assert coroutine.status == CoroutineState.ERROR
+    # Only the drifted node is changed
+    assert [i for i in requests if i[0] != "GET"] == [("POST", "node3.cluster.com/v1/group")]
+    assert sorted(lines[:2], key=lambda i: i["node"]) == [
+        {"node": "node3.cluster.com", "group": "group_1", "expected": "present", "found": "absent", "repair": "done"},
+        {"node": "node4.cluster.com", "group": "group_1", "expected": "present", "found": "unknown",
+         "error": "ERROR 500 in node4.cluster.com: "},
+    ]
+    assert lines[2] == {"group": "group_1", "expected": "present", "consistent": 2, "drifted": 1, "repaired": 1,
+                        "unknown": 1}
+
+
+def test_audit_streams_without_repair():
+
+    nodes = ["node1.cluster.com", "node2.cluster.com"]
+    report = io.StringIO()
+    coroutine = AuditCoroutine(nodes, ["group_1", "group_2"], report, expect="absent", session=NodeSession())
+
+    with aioresponses() as mocker:
+        for node in nodes:
+            mocker.get(node+"/v1/group/group_1", status=404)
+            mocker.get(node+"/v1/group/group_2", status=200 if node == "node2.cluster.com" else 404)
+        coroutine.run()
+
+    asyncio.get_event_loop().run_until_complete(coroutine.session.close())
+    lines = [json.loads(line) for line in report.getvalue().splitlines()]
+    assert coroutine.statuses == {"group_1": CoroutineState.DONE, "group_2": CoroutineState.ERROR}
+    assert lines == [
+        {"node": "node2.cluster.com", "group": "group_2", "expected": "absent", "found": "present"},
+        {"group": "group_1", "expected": "absent", "consistent": 2, "drifted": 0, "repaired": 0, "unknown": 0},
+        {"group": "group_2", "expected": "absent", "consistent": 1, "drifted": 1, "repaired": 0, "unknown": 0},
+    ]
+
+
+@pytest.mark.parametrize("found, code", [(200, 0), (404, 1)])
+def test_audit_cli_exit_code(tmp_path, monkeypatch, found, code):
+
+    # The CLI runs as __main__ and has to share the states of the audit module
+    nodes = tmp_path / "nodes.txt"
+    nodes.write_text("node1.cluster.com\n")
+    monkeypatch.setattr(sys, "argv", [
+        "main.py", "audit", "group_1", str(nodes), "--expect", "present", "--report", str(tmp_path / "report.jsonl"),
+        "--log-file", str(tmp_path / "run.log"),
+    ])
+
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=found, payload={"groupId": "group_1"})
+        with pytest.raises(SystemExit) as exit:
+            runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "main.py"), run_name="__main__")
+
+    assert exit.value.code == code
+
+
+def test_cli_keeps_an_interrupted_journal(tmp_path, monkeypatch):
+
+    nodes = tmp_path / "nodes.txt"
+    nodes.write_text("node1.cluster.com\n")
+    path = tmp_path / "journal.jsonl"
+    interrupted = "".join(json.dumps(record) + "\n" for record in (
+        {"event": "run", "action": "create_group", "groups": ["group_1"]},
+        {"event": "start", "op": "forward", "node": "node1.cluster.com", "group": "group_1"}))
+    path.write_text(interrupted)
+
+    def run(*options):
+        monkeypatch.setattr(sys, "argv", ["main.py", "create_group", "group_1", str(nodes), "--journal", str(path),
+                                          "--log-file", str(tmp_path / "run.log"), *options])
+        try:
+            runpy.run_path(os.path.join(os.path.dirname(__file__), "..", "main.py"), run_name="__main__")
+        except SystemExit as e:
+            return e.code
+
+    # Rejected commands do not touch the journal, and a new run needs the interrupted one to be resumed first
+    assert run("--shards", "2") == "A journal can not be used with shards"
+    assert run("--pipeline", "--waves", "1") == 2
+    assert "finish it with resume first" in run()
+    assert path.read_text() == interrupted
+
+    path.write_text(interrupted + json.dumps({"event": "end", "status": "DONE"}) + "\n")
+    with aioresponses() as mocker:
+        mocker.get("node1.cluster.com/v1/group/group_1", status=200, payload={"groupId": "group_1"})
+        assert run() is None
+    assert [record["event"] for record in map(json.loads, path.read_text().splitlines())] == ["run", "planned", "end"]
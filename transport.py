@@ -0,0 +1,121 @@
+from abc import ABC, abstractmethod
+import asyncio
+import json
+
+import aiohttp
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class TransportError(Exception):
+    pass
+
+
+class Transport(ABC):
+
+    # Sends the requests of a NodeSession. request() returns the response, with a `status` and a coroutine `json()`,
+    # and its text. A request that did not get an answer raises a TransportError, an aiohttp.ClientError or an
+    # asyncio.TimeoutError. Connections are opened lazily, so a transport can be created before the loop runs
+
+    @abstractmethod
+    async def request(self, method, url, timeout=None, **kwargs):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class AiohttpTransport(Transport):
+
+    # HTTP/1.1, one request in flight per connection, idle connections are kept alive for reuse
+    def __init__(self, limit=100, limit_per_host=0, keepalive_timeout=15, ttl_dns_cache=300, trace_configs=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.trace_configs = trace_configs
+        self._session = None
+
+    @property
+    def session(self):
+        # Created lazily so it is bound to the loop that actually runs the requests
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=self.ttl_dns_cache is not None,
+                ttl_dns_cache=self.ttl_dns_cache,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=self.trace_configs)
+        return self._session
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        response = await self.session.request(method, url, timeout=timeout, **kwargs)
+        return response, await response.text()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class Http2Response():
+
+    def __init__(self, response):
+        self.status = response.status_code
+        self.headers = response.headers
+        self.http_version = response.http_version
+        self._text = response.text
+
+    async def text(self):
+        return self._text
+
+    async def json(self):
+        return json.loads(self._text)
+
+
+class Http2Transport(Transport):
+
+    # HTTP/2 with prior knowledge, also over plain http://: the requests to an origin are streams multiplexed over one
+    # connection, so the nodes behind a few hosts need a few sockets and handshakes. Needs httpx[http2]
+    def __init__(self, limit=100, keepalive_timeout=15):
+        if httpx is None:
+            raise TransportError("HTTP/2 needs httpx with HTTP/2 support: pip install 'httpx[http2]'")
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            limits = httpx.Limits(max_connections=self.limit or None, keepalive_expiry=self.keepalive_timeout)
+            self._client = httpx.AsyncClient(http1=False, http2=True, limits=limits)
+        return self._client
+
+    async def request(self, method, url, timeout=None, **kwargs):
+        request = self.client.request(method, url, timeout=self._timeout(timeout), **kwargs)
+        try:
+            if timeout is not None and timeout.total is not None:
+                response = await asyncio.wait_for(request, timeout.total)
+            else:
+                response = await request
+        except httpx.HTTPError as e:
+            raise TransportError(str(e) or e.__class__.__name__)
+        return Http2Response(response), response.text
+
+    @staticmethod
+    def _timeout(timeout):
+        # aiohttp.ClientTimeout of the session, the total one is applied around the request
+        if timeout is None:
+            return httpx.Timeout(None)
+        return httpx.Timeout(None, connect=timeout.connect, read=timeout.sock_read)
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None